@@ -0,0 +1,95 @@
+import re
+from hashlib import sha256
+from os import remove, scandir, stat
+from os.path import isfile, splitext
+from typing import Iterable, Self
+
+from outputs import load_state, save_state, write_atomic
+
+# Characters of the content hash that end up in fingerprinted names
+_fingerprint_length = 12
+_fingerprint = re.compile(r"\.[0-9a-f]{%d}$" % _fingerprint_length)
+
+
+# E.g. media/clip.mp4 becomes media/clip.0123456789ab.mp4
+def fingerprinted_path(path: str, digest: str) -> str:
+    stem, extension = splitext(path)
+    return f"{stem}.{digest[:_fingerprint_length]}{extension}"
+
+
+# Files directly in directory, without fingerprinted copies and without the
+# temporary files write_atomic leaves behind when it's interrupted
+def list_assets(directory: str) -> list[str]:
+    return sorted(entry.path for entry in scandir(directory)
+                  if entry.is_file() and not entry.name.startswith(".")
+                  and not _fingerprint.search(splitext(entry.name)[0]))
+
+
+class AssetManifest:
+    # Content hash of every file the pages link to. A file is only hashed
+    # again when its size or mtime changed, so unchanged media cost a stat()
+    # per build rather than a full read.
+    path: str
+    # Size, mtime and hash by path
+    files: dict
+
+    def __init__(self: Self, path: str):
+        self.path = path
+        self.files = {}
+
+    def load(self: Self) -> None:
+        manifest = load_state(self.path)
+        # Without a manifest every file is simply hashed again
+        if manifest is not None:
+            self.files = manifest.get("files", {})
+
+    def save(self: Self) -> None:
+        save_state(self.path, {"files": self.files})
+
+    # Hashes the new and changed files among paths and forgets every other
+    # file. Fingerprinted copies of content that is gone are removed, returns
+    # those.
+    def update(self: Self, paths: Iterable[str]) -> list[str]:
+        files = {}
+        removed = []
+        for path in paths:
+            info = stat(path)
+            entry = self.files.get(path)
+            if entry is None or entry["size"] != info.st_size or entry["mtime"] != info.st_mtime_ns:
+                with open(path, "rb") as asset_reader:
+                    digest = sha256(asset_reader.read()).hexdigest()
+                if entry is not None and entry["hash"] != digest:
+                    removed += self._remove_copy(path, entry["hash"])
+                entry = {"size": info.st_size, "mtime": info.st_mtime_ns, "hash": digest}
+            files[path] = entry
+
+        for path, entry in self.files.items():
+            if path not in files:
+                removed += self._remove_copy(path, entry["hash"])
+        self.files = files
+        return removed
+
+    def hash(self: Self, path: str) -> str:
+        return self.files[path]["hash"]
+
+    def fingerprinted(self: Self, path: str) -> str:
+        return fingerprinted_path(path, self.files[path]["hash"])
+
+    # Writes the fingerprinted copies that aren't there yet, returns them
+    def write_copies(self: Self) -> list[str]:
+        written = []
+        for path in self.files:
+            copy_path = self.fingerprinted(path)
+            if isfile(copy_path):
+                continue
+            with open(path, "rb") as asset_reader:
+                write_atomic(copy_path, asset_reader.read())
+            written.append(copy_path)
+        return written
+
+    def _remove_copy(self: Self, path: str, digest: str) -> list[str]:
+        copy_path = fingerprinted_path(path, digest)
+        if not isfile(copy_path):
+            return []
+        remove(copy_path)
+        return [copy_path]
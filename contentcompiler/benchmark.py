@@ -0,0 +1,344 @@
+import argparse
+import json
+import random
+import sys
+import tracemalloc
+from contextlib import chdir, redirect_stdout
+from io import StringIO
+from os import listdir, makedirs
+from os.path import dirname, isfile, join, splitext
+from shutil import copyfile
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import frontmatter
+
+from contentcompiler import load_template, parse_blogs
+from mdparser import MarkdownParser
+
+_repo_path = dirname(dirname(__file__))
+_default_baseline_path = join(dirname(__file__), "benchmark_baseline.json")
+# Bump when the layout of the baseline file changes, older ones are ignored
+_baseline_format = 2
+_calibration_steps = 100000
+_min_measure_seconds = 0.5
+
+_words = ("plasma", "mobile", "gesture", "kwin", "task", "switcher", "the", "a",
+          "and", "of", "touch", "corner", "panel", "shell", "review", "merge",
+          "request", "bug", "fix", "animation", "frame", "window", "screen")
+
+# Inputs that used to be expensive for the inline parser: markers that never
+# close. Every generator returns a single block of roughly n characters.
+_adversarial_inputs = {
+    "stray brackets": lambda n: "[" * n,
+    "stray media": lambda n: "![" * (n // 2),
+    "stray stars": lambda n: "* " * (n // 2),
+    "stray backticks": lambda n: "`a " * (n // 3),
+    "brackets before one close": lambda n: "[a" * (n // 2) + "](b)",
+    "double split links": lambda n: "[a](b](c" * (n // 8) + ")",
+    "mixed markers": lambda n: "[*`~~![" * (n // 7),
+    "nested openers": lambda n: "***~~`[" * (n // 7)
+}
+
+
+# Synthetic corpus
+
+def _sentence(rng: random.Random, markup: float) -> str:
+    words = []
+    for _ in range(rng.randint(6, 20)):
+        word = rng.choice(_words)
+        roll = rng.random()
+        if roll < markup * 0.3:
+            word = f"*{word}*"
+        elif roll < markup * 0.5:
+            word = f"**{word}**"
+        elif roll < markup * 0.7:
+            word = f"`{word}`"
+        elif roll < markup * 0.8:
+            word = f"~~{word}~~"
+        elif roll < markup:
+            word = f"[{word}](https://invent.kde.org/{word})"
+        words.append(word)
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng: random.Random, sentences: int, markup: float) -> str:
+    return " ".join(_sentence(rng, markup) for _ in range(sentences))
+
+
+def _list(rng: random.Random, depth: int) -> str:
+    lines = []
+    level = 0
+    for _ in range(rng.randint(4, 12)):
+        lines.append("    " * level + "- " + _sentence(rng, 0.1))
+        level = max(0, min(depth - 1, level + rng.choice((-1, 0, 1))))
+    return "\n".join(lines)
+
+
+def _code_block(rng: random.Random, lines: int) -> str:
+    code = "\n".join(f"    {rng.choice(_words)}({rng.randint(0, 99)}); // {rng.choice(_words)}"
+                     for _ in range(lines))
+    return "```cpp\n" + code + "\n```"
+
+
+def _media(rng: random.Random) -> str:
+    name = rng.choice(_words) + "_" + str(rng.randint(0, 999))
+    extension = rng.choice((".png", ".jpg", ".mp4", ".webm"))
+    return f"![{_sentence(rng, 0)}]({name}{extension})"
+
+
+# Each post shape stresses a different part of the parser and renderer
+_post_shapes = {
+    "long paragraphs": lambda rng: [_paragraph(rng, rng.randint(20, 40), 0.02) for _ in range(6)],
+    "deep lists": lambda rng: [_list(rng, 4) for _ in range(8)],
+    "heavy markup": lambda rng: [_paragraph(rng, 8, 0.6) for _ in range(8)],
+    "large code blocks": lambda rng: [_paragraph(rng, 2, 0.1) + "\n\n" + _code_block(rng, 80) for _ in range(3)],
+    "media heavy": lambda rng: [_paragraph(rng, 2, 0.1) + " " + _media(rng) for _ in range(12)]
+}
+
+
+def generate_corpus(posts: int, seed: int) -> dict[str, str]:
+    rng = random.Random(seed)
+    corpus = {}
+    shapes = list(_post_shapes)
+    for n in range(posts):
+        shape = shapes[n % len(shapes)]
+        blocks = []
+        for block in _post_shapes[shape](rng):
+            blocks.append("#" * rng.randint(1, 3) + " " + _sentence(rng, 0))
+            blocks.append(block)
+        tags = ["KDE", "Plasma Mobile"] if rng.random() < 0.5 else ["Misc"]
+        header = "\n".join((
+            "---",
+            f"title: {shape.capitalize()} {n}",
+            f"description: {_sentence(rng, 0)}",
+            f"date: 20{rng.randint(10, 29)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}T12:00:00",
+            f"preview: {_sentence(rng, 0)}",
+            "tags:",
+            "\n".join(f"    - {tag}" for tag in tags),
+            "---"
+        ))
+        corpus[f"synthetic_{n:05}.md"] = header + "\n\n" + "\n\n".join(blocks) + "\n"
+    return corpus
+
+
+def real_posts() -> dict[str, str]:
+    source_path = join(_repo_path, "blog_sources")
+    posts = {}
+    for source_file in sorted(listdir(source_path)):
+        if splitext(source_file)[1] == ".md":
+            with open(join(source_path, source_file), "r") as blog_reader:
+                posts[source_file] = blog_reader.read()
+    return posts
+
+
+# Stages
+
+def _stage_parse(bodies: list[str]) -> list:
+    return [MarkdownParser().parse(body) for body in bodies]
+
+
+def _stage_render(trees: list) -> None:
+    for tree in trees:
+        tree.html()
+        tree.html(True)
+
+
+def _stage_build(corpus: dict[str, str], template) -> None:
+    with TemporaryDirectory() as build_path:
+        makedirs(join(build_path, "blog_sources"))
+        makedirs(join(build_path, "blog"))
+        for source_file, source in corpus.items():
+            with open(join(build_path, "blog_sources", source_file), "w") as source_writer:
+                source_writer.write(source)
+        # The build also updates the home page and the feeds configured here
+        for file_name in ("index.html", "feeds.json"):
+            copyfile(join(_repo_path, file_name), join(build_path, file_name))
+
+        with chdir(build_path), redirect_stdout(StringIO()):
+            parse_blogs(template, force=True)
+
+
+# Fixed amount of plain Python work that doesn't touch the compiler. Timed
+# next to every stage, it tells how fast the machine is at that moment, so
+# baselines from other machines and runs under load can still be compared.
+def _calibration_loop() -> None:
+    counts = {}
+    for n in range(_calibration_steps):
+        word = _words[n % len(_words)]
+        counts[word] = counts.get(word, 0) + len(word.capitalize())
+
+
+def _time(function) -> float:
+    start = perf_counter()
+    function()
+    return perf_counter() - start
+
+
+def _measure(stage, repeat: int) -> tuple[float, float, int]:
+    best = float("inf")
+    calibration = float("inf")
+    # Stages over in a few milliseconds get more runs, a single hiccup of the
+    # machine would otherwise decide their best time
+    runs = 0
+    spent = 0
+    while runs < repeat or spent < _min_measure_seconds:
+        calibration = min(calibration, _time(_calibration_loop))
+        seconds = _time(stage)
+        best = min(best, seconds)
+        runs += 1
+        spent += seconds
+
+    # Separate run for memory, tracemalloc slows everything down a lot
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, calibration, peak
+
+
+def run_suite(corpus: dict[str, str], repeat: int) -> dict[str, dict]:
+    template = load_template(join(_repo_path, "blog", "blog_template.html"))
+    bodies = [frontmatter.parse(source)[1] for source in corpus.values()]
+    trees = _stage_parse(bodies)
+
+    body_bytes = sum(len(body.encode("utf-8")) for body in bodies)
+    source_bytes = sum(len(source.encode("utf-8")) for source in corpus.values())
+    stages = {
+        "parse": (lambda: _stage_parse(bodies), body_bytes),
+        "render": (lambda: _stage_render(trees), body_bytes),
+        "build": (lambda: _stage_build(corpus, template), source_bytes)
+    }
+
+    results = {}
+    for name, (stage, size) in stages.items():
+        seconds, calibration, peak = _measure(stage, repeat)
+        results[name] = {
+            "seconds": seconds,
+            "calibration_seconds": calibration,
+            "mb_per_second": size / seconds / 1e6,
+            "posts_per_second": len(corpus) / seconds,
+            "peak_memory_mb": peak / 1e6
+        }
+    return results
+
+
+def print_results(title: str, results: dict[str, dict]) -> None:
+    print(title)
+    print(f"    {'stage':<8}{'time':>12}{'MB/s':>10}{'posts/s':>12}{'peak mem':>12}")
+    for name, result in results.items():
+        print(f"    {name:<8}{result['seconds'] * 1000:>10.1f}ms{result['mb_per_second']:>10.2f}"
+              f"{result['posts_per_second']:>12.1f}{result['peak_memory_mb']:>10.1f}MB")
+
+
+# Returns the regressions of results against the baseline as readable lines.
+# Throughput is compared relative to the calibration loop, which scales the
+# baseline to the speed of this machine, peak memory doesn't depend on it.
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]
+        expected_throughput = (expected["mb_per_second"] * expected["calibration_seconds"]
+                               / result["calibration_seconds"])
+        if result["mb_per_second"] < expected_throughput * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['mb_per_second']:.2f} MB/s, "
+                               f"baseline {expected_throughput:.2f} MB/s at the speed of this machine")
+        if result["peak_memory_mb"] > expected["peak_memory_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {result['peak_memory_mb']:.1f} MB, "
+                               f"baseline {expected['peak_memory_mb']:.1f} MB")
+    return regressions
+
+
+def time_parse(source: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        MarkdownParser().parse(source)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def run_adversarial(sizes: list[int], repeat: int) -> None:
+    print(f"{'input':<28}" + "".join(f"{size:>12}" for size in sizes) + "   growth")
+    for name, generate in _adversarial_inputs.items():
+        timings = [time_parse(generate(size), repeat) for size in sizes]
+        # With linear parsing every doubling of the input roughly doubles the
+        # time, quadratic behaviour shows up as a factor of four
+        growth = timings[-1] / timings[-2] if timings[-2] > 0 else 0
+        print(f"{name:<28}" + "".join(f"{timing * 1000:>10.2f}ms" for timing in timings)
+              + f"   x{growth:.1f}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark the Markdown parser, renderer and site build")
+    arg_parser.add_argument(
+        "--posts", type=int, default=200,
+        help="number of posts in the synthetic corpus")
+    arg_parser.add_argument(
+        "--seed", type=int, default=1,
+        help="seed for the synthetic corpus")
+    arg_parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="runs per measurement, the fastest one is reported")
+    arg_parser.add_argument(
+        "--baseline", default=_default_baseline_path,
+        help="baseline file to compare against")
+    arg_parser.add_argument(
+        "--save-baseline", action="store_true",
+        help="store this run as the new baseline instead of comparing")
+    arg_parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="relative slowdown or memory growth that counts as a regression")
+    arg_parser.add_argument(
+        "--adversarial", action="store_true",
+        help="only run the unmatched marker inputs at doubling sizes")
+    arg_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 20000, 40000, 80000],
+        help="adversarial input sizes in characters, each should double the previous one")
+    arguments = arg_parser.parse_args()
+
+    if arguments.adversarial:
+        run_adversarial(arguments.sizes, arguments.repeat)
+        return
+
+    results = {
+        "synthetic": run_suite(generate_corpus(arguments.posts, arguments.seed), arguments.repeat),
+        "real": run_suite(real_posts(), arguments.repeat)
+    }
+    for corpus_name, corpus_results in results.items():
+        print_results(corpus_name, corpus_results)
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, "w") as baseline_writer:
+            json.dump({"format": _baseline_format} | results, baseline_writer, indent=4, sort_keys=True)
+        print("Saved baseline to", arguments.baseline)
+        return
+
+    if not isfile(arguments.baseline):
+        print("No baseline at", arguments.baseline)
+        return
+
+    with open(arguments.baseline, "r") as baseline_reader:
+        baseline = json.load(baseline_reader)
+    if baseline.get("format") != _baseline_format:
+        print("Baseline at", arguments.baseline, "predates the calibration loop, save a new one with --save-baseline")
+        return
+
+    regressions = []
+    for corpus_name, corpus_results in results.items():
+        regressions += [f"{corpus_name} {regression}" for regression in
+                        compare(corpus_results, baseline.get(corpus_name, {}), arguments.tolerance)]
+
+    if regressions:
+        print("Regressions against baseline:")
+        for regression in regressions:
+            print("    " + regression)
+        sys.exit(1)
+    print("No regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
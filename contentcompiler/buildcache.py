@@ -0,0 +1,74 @@
+import pickle
+from os import getpid, makedirs, remove, replace, scandir, utime
+from os.path import isdir, join
+from typing import Self
+
+from buildmanifest import hash_text
+
+
+class BuildCache:
+    # Parsed trees and their rendered fragments on disk, keyed by the hash of
+    # the post body and the parser version. Unlike the build manifest this
+    # survives template and feed changes, and switching back and forth
+    # between versions of a post only ever parses each version once.
+    path: str
+    version: str
+    max_bytes: int
+
+    def __init__(self: Self, path: str, version: str, max_bytes: int = 100 * 1024 * 1024):
+        self.path = path
+        self.version = version
+        self.max_bytes = max_bytes
+
+    def _entry_path(self: Self, content: str) -> str:
+        return join(self.path, hash_text(self.version + content) + ".pickle")
+
+    def get(self: Self, content: str) -> tuple | None:
+        entry_path = self._entry_path(content)
+        try:
+            with open(entry_path, "rb") as entry_reader:
+                entry = pickle.load(entry_reader)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Truncated or otherwise broken entry, parse again and let put()
+            # replace it
+            self._remove(entry_path)
+            return None
+
+        if type(entry) is not tuple or len(entry) != 2:
+            self._remove(entry_path)
+            return None
+
+        # Eviction goes by modification time, mark this entry as recently used
+        utime(entry_path)
+        return entry
+
+    def put(self: Self, content: str, entry: tuple) -> None:
+        makedirs(self.path, exist_ok=True)
+        entry_path = self._entry_path(content)
+        # Write next to the entry and rename, so neither a crash nor parallel
+        # workers leave half written entries behind
+        temp_path = f"{entry_path}.{getpid()}.tmp"
+        with open(temp_path, "wb") as entry_writer:
+            pickle.dump(entry, entry_writer, protocol=pickle.HIGHEST_PROTOCOL)
+        replace(temp_path, entry_path)
+
+    def evict(self: Self) -> None:
+        if not isdir(self.path):
+            return
+
+        entries = [entry for entry in scandir(self.path) if entry.is_file()]
+        entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            self._remove(entry.path)
+
+    def _remove(self: Self, entry_path: str) -> None:
+        try:
+            remove(entry_path)
+        except OSError:
+            pass
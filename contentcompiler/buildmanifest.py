@@ -0,0 +1,105 @@
+from datetime import datetime
+from hashlib import sha256
+from os.path import dirname, isfile, join
+from typing import Iterable, Self
+
+from outputs import load_state, save_state
+
+
+def hash_text(text: str) -> str:
+    return sha256(text.encode("utf-8")).hexdigest()
+
+
+def compiler_version(file_names: Iterable[str]) -> str:
+    # Hash of the given modules of the compiler instead of a hand-maintained
+    # version number, so any change to the parser or renderer invalidates
+    # every post without having to remember to bump anything
+    compiler_path = dirname(__file__)
+    hasher = sha256()
+    for file_name in sorted(file_names):
+        with open(join(compiler_path, file_name), "rb") as source_reader:
+            hasher.update(file_name.encode("utf-8"))
+            hasher.update(source_reader.read())
+    return hasher.hexdigest()
+
+
+class BuildManifest:
+    path: str
+    stamp: str
+    posts: dict
+    # Digest of every generated page that isn't a post, by path
+    pages: dict
+
+    def __init__(self: Self, path: str, stamp: str):
+        self.path = path
+        self.stamp = stamp
+        self.posts = {}
+        self.pages = {}
+
+    def load(self: Self) -> None:
+        manifest = load_state(self.path)
+        if manifest is None:
+            # A missing or broken manifest only costs us a full rebuild
+            return
+        # Pages carry their own digests, they stay valid across stamps
+        self.pages = manifest.get("pages", {})
+        if manifest.get("stamp") != self.stamp:
+            # Template or compiler changed, every post is stale
+            return
+
+        self.posts = manifest.get("posts", {})
+
+    def save(self: Self) -> None:
+        manifest = {
+            "stamp": self.stamp,
+            "posts": self.posts,
+            "pages": self.pages
+        }
+        save_state(self.path, manifest)
+
+    def restamp(self: Self, stamp: str) -> None:
+        if stamp != self.stamp:
+            self.stamp = stamp
+            self.posts = {}
+
+    def is_fresh(self: Self, source_file: str, source_hash: str, dest_path: str) -> bool:
+        entry = self.posts.get(source_file)
+        if entry is None:
+            return False
+        if entry["source_hash"] != source_hash or entry["output"] != dest_path:
+            return False
+        # Someone may have deleted or checked out an older output in between
+        return isfile(dest_path)
+
+    def get(self: Self, source_file: str) -> dict:
+        data = dict(self.posts[source_file]["data"])
+        data["date"] = datetime.fromisoformat(data["date"])
+        return data
+
+    def record(self: Self, source_file: str, source_hash: str, dest_path: str, data: dict) -> None:
+        stored = dict(data)
+        stored["date"] = data["date"].isoformat()
+        self.posts[source_file] = {
+            "source_hash": source_hash,
+            "output": dest_path,
+            "data": stored
+        }
+
+    def prune(self: Self, source_files: list[str]) -> None:
+        # Forget posts whose sources were removed or renamed
+        for source_file in list(self.posts):
+            if source_file not in source_files:
+                del self.posts[source_file]
+
+    def page_is_fresh(self: Self, path: str, digest: str) -> bool:
+        return self.pages.get(path) == digest and isfile(path)
+
+    def record_page(self: Self, path: str, digest: str) -> None:
+        self.pages[path] = digest
+
+    # Forgets pages that weren't generated anymore and returns them
+    def prune_pages(self: Self, paths: set[str]) -> list[str]:
+        removed = [path for path in self.pages if path not in paths]
+        for path in removed:
+            del self.pages[path]
+        return removed
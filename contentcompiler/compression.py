@@ -0,0 +1,63 @@
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from os.path import splitext
+
+from outputs import OutputManifest, write_atomic
+
+# Brotli is optional, without it there are only .gz files. Every suffix used
+# here has to be in outputs.sibling_suffixes.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_compressed_extensions = {".html", ".xml"}
+
+
+def _gzip(data: bytes) -> bytes:
+    # Fixed mtime, so unchanged content compresses to unchanged bytes
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _brotli(data: bytes) -> bytes:
+    return brotli.compress(data, quality=11, mode=brotli.MODE_TEXT)
+
+
+def _compressors() -> dict:
+    compressors = {".gz": _gzip}
+    if brotli is not None:
+        compressors[".br"] = _brotli
+    return compressors
+
+
+# Writes every sibling of path and returns their paths. Runs in the worker
+# threads, zlib and brotli don't hold the GIL while compressing.
+def _compress_file(path: str, compressors: dict) -> list[str]:
+    with open(path, "rb") as output_reader:
+        data = output_reader.read()
+
+    siblings = []
+    for suffix, compress in compressors.items():
+        write_atomic(path + suffix, compress(data))
+        siblings.append(path + suffix)
+    return siblings
+
+
+# Writes precompressed siblings next to every text output whose content
+# changed since they were last written. Returns the written siblings.
+def compress_outputs(outputs: OutputManifest, jobs: int = 1) -> list[str]:
+    compressors = _compressors()
+    pending = [path for path in outputs.files
+               if splitext(path)[1] in _compressed_extensions
+               and not outputs.is_compressed(path, list(compressors))]
+    if not pending:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(_compress_file, pending, [compressors] * len(pending)))
+
+    written = []
+    for path, siblings in zip(pending, results):
+        outputs.record_compressed(path, list(compressors))
+        written += siblings
+    return written
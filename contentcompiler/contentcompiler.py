@@ -1,129 +1,496 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 import frontmatter
-from os import listdir
-from os.path import isfile, join, splitext
+from functools import partial
+from itertools import repeat
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir, scandir, stat
+from os.path import isfile, join, relpath, splitext
 from datetime import datetime, timezone
-from feedgen.feed import FeedGenerator
+from html import escape
+from threading import Thread
+from time import perf_counter, sleep
 
-from mdparser import MarkdownParser
+from mdparser import BlockCache, MarkdownParser
+from mdparsertypes import Tree, use_media, write_fragments
+from pagetemplate import PageTemplate
+from buildmanifest import BuildManifest, compiler_version, hash_text
+from buildcache import BuildCache
+from feeds import load_feed_configs, write_feeds
+from postindex import post_date, scan_posts
+from listings import update_index, write_archives
+from profiler import BuildProfile, PostProfile, phase
+from outputs import OutputManifest, StreamedOutput
+from compression import compress_outputs
+from media import MediaLibrary
+from assets import AssetManifest
 
 _base_url = "https://lprod.dev/"
 _base_blog_url = _base_url + "blog/"
+_manifest_path = ".build_manifest.json"
+_output_manifest_path = ".output_manifest.json"
+_cache_path = ".build_cache"
+_media_cache_path = ".media_cache.json"
+_asset_manifest_path = ".asset_manifest.json"
+# Modules whose code decides what ends up in a post's page and feed entries,
+# development scripts like benchmark.py don't count
+_compiler_modules = ["contentcompiler.py", "mdparser.py", "mdparsertypes.py", "pagetemplate.py", "postindex.py"]
+_media_path = "blog/media"
+_template_path = "blog/blog_template.html"
+_archive_template_path = "blog/archive_template.html"
+_index_path = "index.html"
+_feeds_path = "feeds.json"
+# Stylesheets the post and archive templates link to, by slot
+_stylesheet_slots = {"THEME_CSS": "theme.css", "BLOG_THEME_CSS": "blog/blog_theme.css"}
+_template_slots = {"TITLE", "SUBTITLE", "DATE", "CONTENT"} | _stylesheet_slots.keys()
+_archive_template_slots = {"TITLE", "POSTS"} | _stylesheet_slots.keys()
+_watch_interval = 0.1
+# Size of the excerpts that feeds embed instead of the whole post
+_excerpt_words = 120
+_excerpt_blocks = 4
 
 
-def populate_template(md_data, template):
-    metadata, content = frontmatter.parse(md_data)
+def load_template(path, slots=_template_slots):
+    with open(path, 'r') as template_reader:
+        return PageTemplate(template_reader.read(), slots)
 
-    parsed_tree = MarkdownParser().parse(content)
+
+def parse_content(content, block_cache=None, build_cache=None, profile=None):
+    # A profiled build always parses, a cache hit would show up as a post
+    # that took no time and has no parser counters
+    if build_cache is not None and profile is None:
+        cached = build_cache.get(content)
+        if cached is not None:
+            return cached
+
+    if profile is None:
+        parsed_tree = MarkdownParser(block_cache).parse(content)
+    else:
+        parsed_tree = MarkdownParser(block_cache, profile.stats).parse(content)
+        profile.add_parse()
+
+    with phase(profile, "render"):
+        if block_cache is None:
+            fragments = parsed_tree.fragments()
+        else:
+            fragments = block_cache.fragments(parsed_tree)
+
+    if build_cache is not None:
+        build_cache.put(content, (parsed_tree, fragments))
+    return parsed_tree, fragments
+
+
+# Links to the stylesheets by slot, relative to the pages in blog/
+def stylesheet_links(media=None):
+    links = {}
+    for slot, path in _stylesheet_slots.items():
+        if media is not None:
+            path = media.stylesheets.get(path, path)
+        links[slot] = relpath(path, "blog")
+    return links
+
+
+def populate_template(md_data, template, write, block_cache=None, build_cache=None, profile=None, links=None):
+    with phase(profile, "frontmatter"):
+        metadata, content = frontmatter.parse(md_data)
+
+    parsed_tree, fragments = parse_content(content, block_cache, build_cache, profile)
 
     title = metadata.get("title", "Untitled Blog Post")
     byline = metadata.get("description", "")
     preview = metadata.get("preview", "")
     date = metadata.get("date", "")
-    if type(date) == datetime:
-        full_date = datetime(date.year, date.month, date.day, date.hour, tzinfo=timezone.utc)
-    else:
-        full_date = datetime(date.year, date.month, date.day, tzinfo=timezone.utc)
+    full_date = post_date(date)
 
     date_string = ""
     if date != "":
         date_string = date.strftime("%Y-%m-%d")
-    tags = metadata.get("tags", "")
+    tags = metadata.get("tags") or []
+    if isinstance(tags, str):
+        tags = [tags]
 
-    template = template.replace("$TITLE", title)
-    template = template.replace("$SUBTITLE", byline)
-    template = template.replace("$DATE", date_string)
+    # The tree is walked once for both the page and the feed, only media
+    # nodes get rendered separately for each. The page is streamed into
+    # write, so the post is never held as one big string next to the template
+    with phase(profile, "template"):
+        template.render(write, (links or {}) | {
+            "TITLE": title,
+            "SUBTITLE": byline,
+            "DATE": date_string,
+            "CONTENT": lambda content_write: write_fragments(fragments, content_write, False)
+        })
 
-    content_html = parsed_tree.html()
     # print(parsed_tree.dump())
-    feed_html = parsed_tree.html(True)
-    template = template.replace("$CONTENT", content_html)
+    with phase(profile, "render"):
+        feed_fragments = []
+        write_fragments(fragments, feed_fragments.append, True)
+        feed_html = "".join(feed_fragments).removeprefix(Tree.open_tag).removesuffix(Tree.close_tag)
+
+        excerpt_tree, excerpt_words = parsed_tree.excerpt(_excerpt_words, _excerpt_blocks)
+        if excerpt_words == 0 and preview != "":
+            # Nothing to cut from, e.g. the post starts with a picture
+            excerpt_html = f"<p>{escape(preview)}</p>"
+        else:
+            excerpt_fragments = []
+            excerpt_tree.render_body(excerpt_fragments.append, True)
+            excerpt_html = "".join(excerpt_fragments)
     return {
         "title": title,
         "byline": byline,
         "preview": preview,
         "date": full_date,
         "tags": tags,
-        "body": template,
-        "embed_body": byline + "\n\n" + feed_html
+        "embed_body": byline + "\n\n" + feed_html,
+        "excerpt_body": byline + "\n\n" + excerpt_html
     }
 
 
-def parse_blogs(template):
+# Streams the post's page into dest_path, which is left alone when it comes
+# out the same as output_entry, the output manifest's entry for it. Returns the
+# post's data along with the page's new entry and whether it was written, for
+# OutputManifest.record(). With profile set the data also carries the post's
+# PostProfile. media is a MediaLibrary, it's passed along since worker
+# processes don't share the one of the main process.
+def compile_post(source_file, blog_source, template, dest_path, output_entry, block_cache=None, build_cache=None,
+                 profile=False, media=None):
+    if media is not None:
+        use_media(media.images, media.names)
+    post_profile = PostProfile() if profile else None
+    with StreamedOutput(dest_path, output_entry) as page:
+        data = populate_template(blog_source, template, page.write, block_cache, build_cache, post_profile,
+                                 stylesheet_links(media))
+        with phase(post_profile, "write"):
+            page.close()
+    if post_profile is not None:
+        data["profile"] = post_profile
+    data["page"] = splitext(source_file)[0] + ".html"
+    data["url"] = _base_blog_url + data["page"]
+    return data, page.entry, page.written
+
+
+def template_stamp(template, media=None):
+    # The stamp covers everything besides the post itself that ends up in the
+    # output, changing any of them invalidates every post
+    stamp = template.source + compiler_version(_compiler_modules)
+    if media is not None:
+        stamp += media.digest()
+    return hash_text(stamp)
+
+
+def open_build_cache(max_megabytes):
+    # Only the parser and renderer decide what ends up in the cache
+    version = compiler_version(["mdparser.py", "mdparsertypes.py"])
+    return BuildCache(_cache_path, version, max_megabytes * 1024 * 1024)
+
+
+def open_manifest(template, force=False, media=None):
+    manifest = BuildManifest(_manifest_path, template_stamp(template, media))
+    if not force:
+        manifest.load()
+    return manifest
+
+
+def open_outputs(force=False):
+    outputs = OutputManifest(_output_manifest_path)
+    if not force:
+        outputs.load()
+    return outputs
+
+
+def open_media(fingerprint=False):
+    # Even --force keeps these, they're keyed by content and without Pillow
+    # the resized copies couldn't be made again
+    assets = AssetManifest(_asset_manifest_path)
+    assets.load()
+    media = MediaLibrary(_media_path, _media_cache_path, assets, fingerprint)
+    media.load()
+    return media
+
+
+# manifest can be passed in to keep it warm between builds, changed limits
+# which sources are read and checked at all (everything else that's in the
+# manifest is assumed to be unchanged). block_cache keeps parsed blocks around
+# for serial builds, build_cache keeps parsed posts on disk. Tag and year
+# archive pages are only generated when an archive_template is given. profile
+# collects timings and parser counters of every compiled post. compress writes
+# .gz (and .br) copies of the outputs. media measures and resizes the images
+# the posts show and fingerprints the media and stylesheets. Returns the files
+# that were written or removed, anything else is the same as after the last
+# build.
+def parse_blogs(template, force=False, jobs=1, manifest=None, changed=None, block_cache=None,
+                build_cache=None, archive_template=None, profile=None, compress=False, media=None):
     source_path = "blog_sources"
     dest_path = "blog"
-    source_files = [f for f in listdir(source_path) if isfile(join(source_path, f))]
+    # Sorted, so builds don't depend on the order of the directory listing
+    source_files = sorted(f for f in listdir(source_path) if isfile(join(source_path, f)))
     blogs = []
     print("Parsing blogs", source_files)
 
+    media_written = []
+    media_removed = []
+    if media is not None:
+        media_written, media_removed = media.update(jobs, _stylesheet_slots.values())
+        media.save()
+    if manifest is None:
+        manifest = open_manifest(template, force, media)
+    elif media is not None:
+        # Replaced or resized images change every page that shows them
+        manifest.restamp(template_stamp(template, media))
+    manifest.prune(source_files)
+    outputs = open_outputs(force)
+
+    # Work out what needs compiling first, so the stale posts can be handed
+    # to the worker pool in one go
+    posts = []
     for source_file in source_files:
         if splitext(source_file)[1] != ".md":
             continue
 
-        with open(join(source_path, source_file), 'r') as blog_reader:
-            blog_source = blog_reader.read()
-            data = populate_template(blog_source, template)
+        file_name = splitext(source_file)[0]
+        dest_full_path = join(dest_path, file_name + ".html")
+        if changed is not None and source_file not in changed and source_file in manifest.posts:
+            posts.append((source_file, None, None, dest_full_path, True))
+            continue
+
+        with phase(profile and profile.post(source_file), "read"):
+            with open(join(source_path, source_file), 'r') as blog_reader:
+                blog_source = blog_reader.read()
+
+        source_hash = hash_text(blog_source)
+        # A profiled build compiles every post, like it skips the build cache
+        fresh = profile is None and manifest.is_fresh(source_file, source_hash, dest_full_path)
+        posts.append((source_file, blog_source, source_hash, dest_full_path, fresh))
+
+    stale = [(post[0], post[1], template, post[3], outputs.files.get(post[3])) for post in posts if not post[4]]
+    for source_file, *_ in stale:
+        print("Compiling", source_file)
+
+    # Every page is streamed into its file as it's compiled, by the worker
+    # processes too, rather than held in memory
+    with ExitStack() as stack:
+        if jobs > 1 and len(stale) > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            # map() hands results back in submission order, which keeps the
+            # feeds identical to a serial build
+            chunk_size = max(1, len(stale) // (jobs * 4))
+            compiled = executor.map(compile_post, *zip(*stale), repeat(None), repeat(build_cache),
+                                    repeat(profile is not None), repeat(media), chunksize=chunk_size)
+        else:
+            compiled = (compile_post(*post, block_cache, build_cache, profile is not None, media)
+                        for post in stale)
 
-            file_name = splitext(source_file)[0]
-            data["url"] = _base_blog_url + file_name + ".html"
+        for source_file, _, source_hash, dest_full_path, fresh in posts:
+            if fresh:
+                blogs.append(manifest.get(source_file))
+                outputs.keep(dest_full_path)
+                continue
+
+            data, output_entry, written = next(compiled)
+            if profile is not None:
+                profile.post(source_file).merge(data.pop("profile"))
+            outputs.record(dest_full_path, output_entry, written)
             blogs.append(data)
+            manifest.record(source_file, source_hash, dest_full_path, data)
+    if build_cache is not None:
+        build_cache.evict()
+
+    # Oldest first, like the list has always been on the home page. Posts from
+    # the same date by file name, feeds keep that order as well.
+    blogs.sort(key=lambda blog: (blog["date"], blog["page"]))
+    update_index(_index_path, blogs, outputs)
+    if archive_template is not None:
+        write_archives(blogs, archive_template, dest_path, manifest, outputs, stylesheet_links(media))
+
+    manifest.save()
+    feed_configs = load_feed_configs(_feeds_path)
+    write_feeds(blogs, feed_configs, _base_url, datetime.now(timezone.utc), outputs, profile and profile.feeds)
+
+    changed_files = media_written + outputs.changed
+    # Whatever wasn't written or kept isn't an output of this build anymore,
+    # e.g. the page of a deleted post
+    outputs.prune()
+    if compress:
+        changed_files += compress_outputs(outputs, jobs)
+    outputs.save()
+    # Precompressed copies of changed outputs are removed, and with compress
+    # written again
+    removed_files = [path for path in dict.fromkeys(media_removed + outputs.removed) if not isfile(path)]
+    for path in changed_files:
+        print("Updated", path)
+    for path in removed_files:
+        print("Removed", path)
+    return changed_files + removed_files
+
+
+# Regenerates the post list in index.html from the post headers alone, no
+# post body is read or parsed. Returns whether the file changed.
+def update_listings():
+    blogs = [post.listing() for post in scan_posts("blog_sources")]
+    # Oldest first like parse_blogs, posts from the same date by file name
+    blogs.sort(key=lambda blog: (blog["date"], blog["page"]))
+    outputs = open_outputs()
+    changed = update_index(_index_path, blogs, outputs)
+    outputs.save()
+    if changed:
+        print("Updated", _index_path)
+    return changed
 
-            dest_full_path = join(dest_path, file_name + ".html")
-            with open(dest_full_path, "w") as blog_writer:
-                blog_writer.write(data["body"])
-
-    kde_feed = FeedGenerator()
-    kde_feed.title("lprod KDE Blog")
-    kde_feed.link(href=_base_url + "kde_rss.xml", rel="alternate")
-    kde_feed.link(href=_base_url + "kde_rss.xml", rel="self")
-    kde_feed.description("My exploits in and around KDE projects")
-    kde_feed.language("en")
-    kde_feed.lastBuildDate(datetime.now(timezone.utc))
-
-    global_feed = FeedGenerator()
-    global_feed.title("lprod Blog")
-    global_feed.link(href=_base_url + "rss.xml", rel="alternate")
-    global_feed.link(href=_base_url + "rss.xml", rel="self")
-    global_feed.description("Random ramblings in various projects I work on")
-    global_feed.language("en")
-    global_feed.lastBuildDate(datetime.now(timezone.utc))
-
-    for blog in blogs:
-        global_entry = global_feed.add_entry()
-        global_entry.id(blog["url"])
-        global_entry.title(blog["title"])
-        global_entry.link(href=blog["url"])
-        global_entry.description(blog["embed_body"])
-        global_entry.author({"name": "Luis Büchi"})
-        global_entry.published(blog["date"])
-
-        if "KDE" in blog["tags"]:
-            kde_entry = kde_feed.add_entry()
-            kde_entry.id(blog["url"])
-            kde_entry.title(blog["title"])
-            kde_entry.link(href=blog["url"])
-            kde_entry.description(blog["embed_body"])
-            kde_entry.author({"name": "Luis Büchi"})
-            kde_entry.published(blog["date"])
-
-    # print(global_feed.rss_str(pretty=True))
-    global_feed.rss_file("rss.xml")
-    # global_feed.atom_file("atom.xml")
-    # print(kde_feed.rss_str(pretty=True))
-    kde_feed.rss_file("kde_rss.xml")
-    # kde_feed.atom_file("kde_atom.xml")
+
+def _watched_files(template_path):
+    files = {template_path: stat(template_path)}
+    for entry in scandir("blog_sources"):
+        if entry.is_file() and splitext(entry.name)[1] == ".md":
+            files[entry.name] = entry.stat()
+    return {path: (info.st_mtime_ns, info.st_size) for path, info in files.items()}
+
+
+def watch_blogs(template_path, port, force=False, jobs=1, build_cache=None, archive_template=None, media=None):
+    # Serve the whole site rather than just blog/, posts link back to the
+    # theme and index one level up
+    server = ThreadingHTTPServer(("localhost", port), partial(SimpleHTTPRequestHandler, directory="."))
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving preview at http://localhost:{port}/blog/")
+
+    template = load_template(template_path)
+    if media is not None:
+        # The stamp covers the images, so they have to be known before the
+        # manifest is loaded
+        media.update(jobs, _stylesheet_slots.values())
+    manifest = open_manifest(template, force, media)
+    block_cache = BlockCache()
+    # Files changed since the last build that went through, None before the
+    # first one. A build that fails, e.g. on a half-typed post header, is
+    # reported and tried again with them on the next change.
+    pending = None
+    watched = None
+
+    try:
+        while True:
+            try:
+                current = _watched_files(template_path)
+            except Exception as error:
+                # E.g. an editor saving by rename, the file is back on the next poll
+                print("Watch error:", error)
+                current = watched
+
+            if current != watched:
+                if watched is not None:
+                    pending |= {path for path in current.keys() | watched.keys()
+                                if current.get(path) != watched.get(path)}
+                watched = current
+
+                start = perf_counter()
+                try:
+                    if pending is not None and template_path in pending:
+                        template = load_template(template_path)
+                        # Every post depends on the template
+                        manifest.restamp(template_stamp(template, media))
+                    parse_blogs(template, jobs=jobs, manifest=manifest, changed=pending, block_cache=block_cache,
+                                build_cache=build_cache, archive_template=archive_template, media=media)
+                except Exception as error:
+                    print("Build error:", error)
+                    if pending is None:
+                        # The first build may have stopped before looking at
+                        # some of the posts, they can't be assumed unchanged
+                        pending = set(current)
+                else:
+                    if pending is not None:
+                        print(f"Rebuilt in {(perf_counter() - start) * 1000:.1f}ms")
+                    pending = set()
+            sleep(_watch_interval)
+    except KeyboardInterrupt:
+        server.shutdown()
 
 
 def main():
     arg_parser = argparse.ArgumentParser(
         description="Compile Markdown files into HTML files based on template")
+    arg_parser.add_argument(
+        "--force", action="store_true",
+        help="ignore the build manifest and recompile every post")
+    arg_parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of worker processes used to compile posts")
+    arg_parser.add_argument(
+        "--watch", action="store_true",
+        help="keep running, recompile posts as they change and serve the site")
+    arg_parser.add_argument(
+        "--port", type=int, default=8000,
+        help="port of the preview server in watch mode")
+    arg_parser.add_argument(
+        "--no-cache", action="store_true",
+        help="don't use the on-disk cache of parsed posts")
+    arg_parser.add_argument(
+        "--cache-size", type=int, default=100,
+        help="size limit of the on-disk cache in megabytes")
+    arg_parser.add_argument(
+        "--list", action="store_true",
+        help="only list the posts, newest first, without compiling anything")
+    arg_parser.add_argument(
+        "--listings", action="store_true",
+        help="only update the post list in index.html from the post headers, without compiling anything")
+    arg_parser.add_argument(
+        "--archives", action="store_true",
+        help="also generate a page per tag and per year listing its posts")
+    arg_parser.add_argument(
+        "--compress", action="store_true",
+        help="write precompressed .gz and, if brotli is installed, .br copies of every generated page and feed")
+    arg_parser.add_argument(
+        "--fingerprint", action="store_true",
+        help="link to copies of the media and stylesheets named after their content hash, "
+             "so they can be served as immutable")
+    arg_parser.add_argument(
+        "--changed-files", metavar="PATH",
+        help="write the files this build wrote or removed to PATH, one per line, e.g. for syncing only those "
+             "to the server. The removed ones don't exist anymore.")
+    arg_parser.add_argument(
+        "--profile", nargs="?", const="build_profile.json", metavar="PATH",
+        help="recompile every post timing each phase, print a summary and store the details as JSON")
     arguments = arg_parser.parse_args()
+    if arguments.profile and arguments.watch:
+        arg_parser.error("--profile can't be combined with --watch")
+    if arguments.compress and arguments.watch:
+        arg_parser.error("--compress can't be combined with --watch")
+
+    if arguments.list:
+        for post in scan_posts("blog_sources"):
+            print(f"{post.date:%Y-%m-%d}  {post.source_file:<32} {post.title} [{', '.join(post.tags)}]")
+        return
+    if arguments.listings:
+        update_listings()
+        return
+
+    build_cache = None
+    if not arguments.no_cache:
+        build_cache = open_build_cache(arguments.cache_size)
+
+    archive_template = None
+    if arguments.archives:
+        archive_template = load_template(_archive_template_path, _archive_template_slots)
+
+    media = open_media(arguments.fingerprint)
+    if arguments.watch:
+        watch_blogs(_template_path, arguments.port, arguments.force, arguments.jobs, build_cache, archive_template,
+                    media)
+        return
+
+    profile = None
+    if arguments.profile:
+        profile = BuildProfile()
 
-    template = ""
-    with open('blog/blog_template.html', 'r') as template_reader:
-        template = template_reader.read()
+    template = load_template(_template_path)
+    changed_files = parse_blogs(template, arguments.force, arguments.jobs, build_cache=build_cache,
+                                archive_template=archive_template, profile=profile, compress=arguments.compress,
+                                media=media)
+    if arguments.changed_files:
+        with open(arguments.changed_files, "w") as changed_writer:
+            changed_writer.writelines(path + "\n" for path in changed_files)
 
-    parse_blogs(template)
+    if profile is not None:
+        print(profile.summary())
+        profile.save(arguments.profile)
+        print("Saved profile to", arguments.profile)
 
 
 if __name__ == '__main__':
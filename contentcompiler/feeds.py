@@ -0,0 +1,199 @@
+import heapq
+import json
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from email.utils import format_datetime
+from hashlib import sha256
+from typing import Iterable, Self
+from xml.sax.saxutils import escape, quoteattr
+
+from mdparsertypes import Sink
+from outputs import OutputManifest
+from profiler import PostProfile, phase
+
+_generator = "lprod contentcompiler"
+# Second line of every feed, identifies its content without the build date
+_digest_comment = re.compile(r"<!-- digest: ([0-9a-f]{64}) -->")
+
+
+@dataclass(slots=True)
+class FeedConfig:
+    title: str
+    description: str
+    # Output file per format, "rss" and/or "atom"
+    outputs: dict[str, str]
+    # Posts with any of these tags, None for every post
+    tags: list[str] | None = None
+    max_items: int | None = None
+    language: str = "en"
+    author: str = ""
+    # Embed an excerpt of each post instead of all of it
+    excerpt: bool = False
+
+    @classmethod
+    def from_dict(cls, config: dict) -> Self:
+        unknown_formats = set(config["outputs"]) - set(_entry_writers)
+        if unknown_formats:
+            raise ValueError(f"Unknown feed formats {sorted(unknown_formats)} for {config['title']}")
+        return cls(**config)
+
+
+def load_feed_configs(path: str) -> list[FeedConfig]:
+    with open(path, "r") as config_reader:
+        config = json.load(config_reader)
+    defaults = config.get("defaults", {})
+    return [FeedConfig.from_dict(defaults | feed) for feed in config["feeds"]]
+
+
+def _text(text: str) -> str:
+    return escape(text, {"\r": "&#13;"})
+
+
+def _rss_entry(blog: dict, author: str, body: str) -> str:
+    return "".join((
+        "<item>",
+        f"<title>{_text(blog['title'])}</title>",
+        f"<link>{_text(blog['url'])}</link>",
+        f"<description>{_text(body)}</description>",
+        f"<guid isPermaLink=\"false\">{_text(blog['url'])}</guid>",
+        f"<pubDate>{format_datetime(blog['date'])}</pubDate>",
+        "</item>"
+    ))
+
+
+def _atom_entry(blog: dict, author: str, body: str) -> str:
+    return "".join((
+        "<entry>",
+        f"<id>{_text(blog['url'])}</id>",
+        f"<title>{_text(blog['title'])}</title>",
+        f"<updated>{blog['date'].isoformat()}</updated>",
+        f"<published>{blog['date'].isoformat()}</published>",
+        f"<link href={quoteattr(blog['url'])} rel=\"alternate\"/>",
+        f"<author><name>{_text(author)}</name></author>",
+        f"<content type=\"html\">{_text(body)}</content>",
+        "</entry>"
+    ))
+
+
+def _rss_feed(write: Sink, config: FeedConfig, url: str, build_date: datetime | None,
+              entries: Iterable[str]) -> None:
+    write("<rss xmlns:atom=\"http://www.w3.org/2005/Atom\" version=\"2.0\"><channel>")
+    write(f"<title>{_text(config.title)}</title>")
+    write(f"<link>{_text(url)}</link>")
+    write(f"<description>{_text(config.description)}</description>")
+    write(f"<atom:link href={quoteattr(url)} rel=\"self\"/>")
+    write("<docs>http://www.rssboard.org/rss-specification</docs>")
+    write(f"<generator>{_generator}</generator>")
+    write(f"<language>{_text(config.language)}</language>")
+    if build_date is not None:
+        write(f"<lastBuildDate>{format_datetime(build_date)}</lastBuildDate>")
+    for entry in entries:
+        write(entry)
+    write("</channel></rss>")
+
+
+def _atom_feed(write: Sink, config: FeedConfig, url: str, build_date: datetime | None,
+               entries: Iterable[str]) -> None:
+    write(f"<feed xmlns=\"http://www.w3.org/2005/Atom\" xml:lang={quoteattr(config.language)}>")
+    write(f"<id>{_text(url)}</id>")
+    write(f"<title>{_text(config.title)}</title>")
+    if build_date is not None:
+        write(f"<updated>{build_date.isoformat()}</updated>")
+    write(f"<link href={quoteattr(url)} rel=\"self\"/>")
+    write(f"<subtitle>{_text(config.description)}</subtitle>")
+    write(f"<generator>{_generator}</generator>")
+    for entry in entries:
+        write(entry)
+    write("</feed>")
+
+
+_entry_writers = {"rss": _rss_entry, "atom": _atom_entry}
+_feed_writers = {"rss": _rss_feed, "atom": _atom_feed}
+
+
+def _tags(blog: dict) -> list[str]:
+    tags = blog["tags"]
+    if isinstance(tags, str):
+        return [tags] if tags else []
+    return tags
+
+
+# Newest posts first, at most max_items of them. Posts with the same date keep
+# their source order.
+def _select_newest(blogs: list[dict], candidates: Iterable[int], max_items: int | None) -> list[int]:
+    if max_items is None:
+        return sorted(candidates, key=lambda n: blogs[n]["date"], reverse=True)
+    return heapq.nlargest(max_items, candidates, key=lambda n: blogs[n]["date"])
+
+
+def _feed_digest(feed_writer, config: FeedConfig, url: str, entries: list[str]) -> str:
+    # Everything that ends up in the feed except the build date, so a build
+    # that didn't change any entry leaves the file alone
+    hasher = sha256()
+    feed_writer(lambda text: hasher.update(text.encode("utf-8")), config, url, None, entries)
+    return hasher.hexdigest()
+
+
+def _stored_digest(file_name: str) -> str | None:
+    try:
+        with open(file_name, "r") as feed_reader:
+            feed_reader.readline()
+            match = _digest_comment.fullmatch(feed_reader.readline().rstrip("\n"))
+    except OSError:
+        return None
+    return match.group(1) if match else None
+
+
+# Returns the feed files that were rewritten
+def write_feeds(blogs: list[dict], configs: list[FeedConfig], base_url: str, build_date: datetime,
+                outputs: OutputManifest, profile: PostProfile | None = None) -> list[str]:
+    # Which posts carry which tag, built in one pass for all feeds
+    with phase(profile, "feed build"):
+        tag_index = {}
+        for n, blog in enumerate(blogs):
+            for tag in _tags(blog):
+                tag_index.setdefault(tag, []).append(n)
+
+    # Serialized entries by format, post, author and body. Every entry is only
+    # serialized once, no matter how many feeds it ends up in.
+    entries = {output_format: {} for output_format in _entry_writers}
+
+    written = []
+    for config in configs:
+        with phase(profile, "feed build"):
+            if config.tags is None:
+                candidates = range(len(blogs))
+            else:
+                candidates = sorted({n for tag in config.tags for n in tag_index.get(tag, [])})
+            selected = _select_newest(blogs, candidates, config.max_items)
+
+        for output_format, file_name in config.outputs.items():
+            with phase(profile, "feed serialize"):
+                if _write_feed(output_format, file_name, config, blogs, selected, entries, base_url, build_date,
+                               outputs):
+                    written.append(file_name)
+    return written
+
+
+# Writes one feed file unless its content didn't change, returns whether it did
+def _write_feed(output_format: str, file_name: str, config: FeedConfig, blogs: list[dict], selected: list[int],
+                entries: dict, base_url: str, build_date: datetime, outputs: OutputManifest) -> bool:
+    format_entries = entries[output_format]
+    body = "excerpt_body" if config.excerpt else "embed_body"
+    for n in selected:
+        if (n, config.author, body) not in format_entries:
+            format_entries[n, config.author, body] = _entry_writers[output_format](
+                blogs[n], config.author, blogs[n][body])
+    feed_entries = [format_entries[n, config.author, body] for n in selected]
+
+    feed_writer = _feed_writers[output_format]
+    url = base_url + file_name
+    digest = _feed_digest(feed_writer, config, url, feed_entries)
+    if digest == _stored_digest(file_name):
+        outputs.keep(file_name)
+        return False
+
+    feed = ["<?xml version='1.0' encoding='UTF-8'?>\n", f"<!-- digest: {digest} -->\n"]
+    feed_writer(feed.append, config, url, build_date, feed_entries)
+    return outputs.write(file_name, "".join(feed))
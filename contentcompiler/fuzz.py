@@ -0,0 +1,226 @@
+import argparse
+import json
+import random
+import subprocess
+import sys
+from io import StringIO
+from os.path import dirname, join
+from tempfile import TemporaryDirectory
+
+from mdparser import MarkdownParser
+from mdparsertypes import FlatTree, Tree
+
+_repo_path = dirname(dirname(__file__))
+# Modules the parser is made of, they're taken from the reference revision
+_parser_modules = ("mdparser.py", "mdparsertypes.py")
+
+_words = ("plasma", "mobile", "gesture", "kwin", "task", "switcher", "the", "a",
+          "and", "of", "touch", "corner", "panel", "shell", "review", "merge")
+
+# Runs in a directory holding the reference parser, sources come in and HTML
+# goes out as JSON, for the page and the feed variant of each. Older parsers
+# crash on some inputs, those come out as null.
+_reference_script = """
+import json, sys
+from mdparser import MarkdownParser
+
+def html(source):
+    try:
+        tree = MarkdownParser().parse(source)
+        return [tree.html(), tree.html(True)]
+    except Exception:
+        return None
+
+json.dump([html(source) for source in json.load(sys.stdin)], sys.stdout)
+"""
+
+
+# Well-formed markup only: every marker is closed, spans nest properly and
+# never overlap. Malformed markup is allowed to come out differently between
+# parser versions, see the adversarial inputs of benchmark.py.
+
+def _word(rng: random.Random) -> str:
+    return rng.choice(_words)
+
+
+def _span(rng: random.Random, depth: int, enclosing: frozenset[str]) -> str:
+    if depth > 2:
+        return _word(rng)
+    roll = rng.random()
+    marker = "*" if roll < 0.45 else "**" if roll < 0.6 else "~~" if roll < 0.7 else ""
+    if marker in enclosing:
+        # A marker inside a span of the same marker closes it instead
+        marker = ""
+    text = " ".join(_inline(rng, depth + 1, enclosing | {marker}) for _ in range(rng.randint(1, 3)))
+    if roll < 0.3 or not (text[0].isalpha() and text[-1].isalpha()):
+        # Markers right next to each other, like ***, are ambiguous
+        return text
+    if roll < 0.7:
+        return f"{marker}{text}{marker}"
+    if roll < 0.8:
+        # No markers in code spans, the parser before the delimiter stack
+        # ended a code span at the first one
+        return f"`{_word(rng)} {_word(rng)}`"
+    if roll < 0.9:
+        return f"[{_word(rng)} {_word(rng)}](https://invent.kde.org/{_word(rng)})"
+    return f"![{_word(rng)}]({_word(rng)}{rng.choice(('.png', '.jpg', '.mp4', '.webm'))})"
+
+
+def _inline(rng: random.Random, depth: int = 0, enclosing: frozenset[str] = frozenset()) -> str:
+    if rng.random() < 0.5:
+        return _word(rng)
+    return _span(rng, depth, enclosing)
+
+
+# Starts with a word, a * at the start of a line could be a list bullet
+def _line(rng: random.Random) -> str:
+    return " ".join([_word(rng)] + [_inline(rng) for _ in range(rng.randint(0, 7))])
+
+
+def _block(rng: random.Random) -> str:
+    roll = rng.random()
+    if roll < 0.15:
+        return "#" * rng.randint(1, 3) + " " + _line(rng)
+    if roll < 0.35:
+        lines = []
+        level = 0
+        for _ in range(rng.randint(1, 6)):
+            lines.append("    " * level + "- " + _line(rng))
+            level = max(0, min(3, level + rng.choice((-1, 0, 1))))
+        return "\n".join(lines)
+    if roll < 0.45:
+        code = "\n".join(f"{_word(rng)} <{_word(rng)}> & *{_word(rng)}*" for _ in range(rng.randint(1, 4)))
+        return f"```{rng.choice(('', 'cpp', 'py'))}\n{code}\n```"
+    return "\n".join(_line(rng) for _ in range(rng.randint(1, 3)))
+
+
+def _source(rng: random.Random) -> str:
+    blocks = []
+    for _ in range(rng.randint(1, 8)):
+        block = _block(rng)
+        # A fence only opens a code block after a paragraph, anywhere else
+        # it's taken as inline backticks. Paragraphs after a list are taken
+        # as one more item of it.
+        while block.startswith("```") and (not blocks or blocks[-1].startswith(("- ", "#", "```"))
+                                           or any(other.startswith("- ") for other in blocks)):
+            block = _block(rng)
+        blocks.append(block)
+    return "\n\n".join(blocks) + "\n"
+
+
+def generate_sources(count: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    return [_source(rng) for _ in range(count)]
+
+
+# Checks, each returns the indices of the sources it failed on and the ones
+# it couldn't check
+
+def _html(tree: Tree) -> list[str]:
+    return [tree.html(), tree.html(True)]
+
+
+# HTML of every source as rendered by the parser at revision, or by the one
+# in the working tree for None
+def _revision_html(sources: list[str], revision: str | None) -> list[list[str] | None]:
+    with TemporaryDirectory() as parser_path:
+        if revision is None:
+            parser_path = dirname(__file__)
+        for module in _parser_modules if revision is not None else ():
+            source = subprocess.run(["git", "show", f"{revision}:contentcompiler/{module}"], cwd=_repo_path,
+                                    check=True, capture_output=True).stdout
+            with open(join(parser_path, module), "wb") as module_writer:
+                module_writer.write(source)
+        result = subprocess.run([sys.executable, "-c", _reference_script], cwd=parser_path,
+                                input=json.dumps(sources), capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Parser at {revision or 'the working tree'} failed:\n{result.stderr}")
+    return json.loads(result.stdout)
+
+
+def _check_reference(sources: list[str], reference: str, revision: str | None) -> tuple[list[int], list[int]]:
+    expected = _revision_html(sources, reference)
+    actual = _revision_html(sources, revision)
+    skipped = [n for n in range(len(sources)) if expected[n] is None]
+    return [n for n in range(len(sources)) if expected[n] is not None and actual[n] != expected[n]], skipped
+
+
+def _check_streaming(sources: list[str]) -> tuple[list[int], list[int]]:
+    failed = []
+    for n, source in enumerate(sources):
+        # Small chunks, so blocks get split across them
+        blocks = list(MarkdownParser().iter_blocks(StringIO(source), chunk_size=7))
+        if _html(Tree(blocks)) != _html(MarkdownParser().parse(source)):
+            failed.append(n)
+    return failed, []
+
+
+def _check_flat(sources: list[str]) -> tuple[list[int], list[int]]:
+    failed = []
+    for n, source in enumerate(sources):
+        tree = MarkdownParser().parse(source)
+        flat = FlatTree.from_tree(tree, source)
+        if any(_render(flat, external) != _render(tree, external) for external in (False, True)):
+            failed.append(n)
+    return failed, []
+
+
+def _check_parallel(sources: list[str]) -> tuple[list[int], list[int]]:
+    parallel = MarkdownParser().parse_many(sources, workers=4)
+    return [n for n, source in enumerate(sources)
+            if _html(parallel[n]) != _html(MarkdownParser().parse(source))], []
+
+
+def _render(tree, external: bool) -> str:
+    fragments = []
+    tree.render(fragments.append, external)
+    return "".join(fragments)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Check the Markdown parser against an earlier revision of itself and its own variants "
+                    "on randomly generated, well-formed markup")
+    arg_parser.add_argument(
+        "--count", type=int, default=2000,
+        help="number of generated sources")
+    arg_parser.add_argument(
+        "--seed", type=int, default=0,
+        help="seed for the generated sources")
+    arg_parser.add_argument(
+        "--reference", default="HEAD", metavar="REVISION",
+        help="git revision whose parser the checked one has to match, e.g. the one before a parser change")
+    arg_parser.add_argument(
+        "--revision", metavar="REVISION",
+        help="git revision whose parser is checked against the reference instead of the working tree, "
+             "e.g. to verify an earlier parser change")
+    arg_parser.add_argument(
+        "--no-reference", action="store_true",
+        help="only check streaming, flat trees and parse_many() against parse()")
+    arguments = arg_parser.parse_args()
+
+    sources = generate_sources(arguments.count, arguments.seed)
+    checks = {
+        "streaming": _check_streaming,
+        "flat tree": _check_flat,
+        "parse_many": _check_parallel
+    }
+    if not arguments.no_reference:
+        checks[f"reference {arguments.reference}"] = lambda sources: _check_reference(sources, arguments.reference,
+                                                                                  arguments.revision)
+
+    failures = 0
+    for name, check in checks.items():
+        failed, skipped = check(sources)
+        failures += len(failed)
+        checked = len(sources) - len(skipped)
+        print(f"{name:<24}{checked - len(failed)}/{checked} identical"
+              + (f", {len(skipped)} skipped where the reference crashed" if skipped else ""))
+        for n in failed[:3]:
+            print(f"    first differing source (#{n}):")
+            print("    " + sources[n].replace("\n", "\n    "))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import re
+from os.path import join
+from typing import Iterable
+
+from buildmanifest import BuildManifest, hash_text
+from outputs import OutputManifest
+from pagetemplate import PageTemplate
+
+# The generated part of index.html sits between these, everything else in it
+# is left alone
+_index_start = "<!-- posts -->"
+_index_end = "<!-- /posts -->"
+_listing_indent = " " * 12
+
+
+def _slug(tag: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", tag.lower()).strip("_")
+
+
+# Archive page file name by tag. Tags that come out as the same slug, e.g. C++
+# and C, get a hash of the tag appended so each keeps a page of its own.
+def _tag_file_names(tags: Iterable[str]) -> dict[str, str]:
+    tags_by_slug = {}
+    for tag in tags:
+        tags_by_slug.setdefault(_slug(tag), set()).add(tag)
+
+    file_names = {}
+    for slug, slug_tags in tags_by_slug.items():
+        for tag in slug_tags:
+            name = slug
+            if len(slug_tags) > 1 or not slug:
+                name = "_".join(filter(None, (slug, hash_text(tag)[:8])))
+            file_names[tag] = f"tag_{name}.html"
+    return file_names
+
+
+def _listing(blogs: list[dict], link_prefix: str, indent: str) -> str:
+    return "\n".join(f"{indent}<li>{blog['date']:%Y-%m-%d}: "
+                     f"<a href=\"{link_prefix}{blog['page']}\">{blog['title']}</a></li>"
+                     for blog in blogs)
+
+
+# Replaces the post list in index.html with blogs, which are expected to be
+# sorted by date already. Returns whether the file changed.
+def update_index(path: str, blogs: list[dict], outputs: OutputManifest) -> bool:
+    with open(path, "r") as index_reader:
+        index = index_reader.read()
+
+    start = index.find(_index_start)
+    end = index.find(_index_end, start)
+    if start < 0 or end < 0:
+        raise ValueError(f"No {_index_start} {_index_end} markers in {path}")
+    indent = index[index.rfind("\n", 0, start) + 1:start]
+
+    updated = "".join((
+        index[:start + len(_index_start)], "\n",
+        _listing(blogs, "blog/", indent), "\n",
+        indent, index[end:]
+    ))
+    return outputs.write(path, updated)
+
+
+# Archive page file names with their title and posts, one page per tag and
+# one per year
+def archive_pages(blogs: list[dict]) -> dict[str, tuple[str, list[dict]]]:
+    tag_file_names = _tag_file_names(tag for blog in blogs for tag in blog["tags"])
+    pages = {}
+    for blog in blogs:
+        for tag in blog["tags"]:
+            pages.setdefault(tag_file_names[tag], (f"Posts tagged {tag}", []))[1].append(blog)
+        year = blog["date"].year
+        pages.setdefault(f"archive_{year}.html", (f"Posts from {year}", []))[1].append(blog)
+    return pages
+
+
+# Writes the archive pages whose posts changed since the last build and
+# removes the ones that have no posts left. links are the values of the
+# template's other slots, e.g. its stylesheets. Returns the written pages.
+def write_archives(blogs: list[dict], template: PageTemplate, dest_path: str,
+                   manifest: BuildManifest, outputs: OutputManifest, links: dict[str, str] | None = None) -> list[str]:
+    links = links or {}
+    links_text = "".join(f"{slot}={link}\n" for slot, link in sorted(links.items()))
+    written = []
+    paths = set()
+    for file_name, (title, posts) in archive_pages(blogs).items():
+        path = join(dest_path, file_name)
+        paths.add(path)
+        listing = _listing(posts, "", _listing_indent)
+        # Building the listing is cheap, writing every page on each build
+        # isn't. The digest tells whether this page's posts changed at all.
+        digest = hash_text(template.source + links_text + title + listing)
+        if manifest.page_is_fresh(path, digest):
+            outputs.keep(path)
+            continue
+
+        page = []
+        template.render(page.append, links | {"TITLE": title, "POSTS": listing})
+        if outputs.write(path, "".join(page)):
+            written.append(path)
+        manifest.record_page(path, digest)
+
+    for path in manifest.prune_pages(paths):
+        outputs.remove(path)
+    return written
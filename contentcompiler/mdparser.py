@@ -1,4 +1,11 @@
-from typing import Self, Callable
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from dataclasses import dataclass
+from threading import Lock
+from time import perf_counter
+from typing import Iterable, Iterator, Self, TextIO
 from mdparsertypes import (
     Node,
     Tree,
@@ -16,25 +23,147 @@ from mdparsertypes import (
     MediaNode
 )
 
+# Tokens that can open or close inline markup. Anything in between is plain
+# text and is skipped over in one go
+_inline_tokens = re.compile(r"\*+|`|~~|!\[|\[")
+
+# Symmetric rules: the same marker opens and closes them
+_symmetric_rules = {
+    "`": ("inline_code", InlineCodeNode),
+    "~~": ("strikethrough", StrikethroughNode)
+}
+_star_rules = {
+    "*": ("italics", ItalicsNode),
+    "**": ("bold", BoldNode)
+}
+
+
+class _Frame:
+    # An opened but not yet closed piece of inline markup
+    __slots__ = ("kind", "marker", "node_type", "children")
+
+    def __init__(self: Self, kind: str, marker: str, node_type: type, children: list[Node]):
+        self.kind = kind
+        self.marker = marker
+        self.node_type = node_type
+        self.children = children
+
+
+@dataclass(slots=True)
+class ParserStats:
+    # How much work a parser did, only counted when it's given one of these
+    characters: int = 0
+    blocks: int = 0
+    cached_blocks: int = 0
+    inline_characters: int = 0
+    inline_tokens: int = 0
+    # Markers and brackets that didn't turn into markup and became text
+    fallbacks: int = 0
+    peeks: int = 0
+    consumes: int = 0
+    max_list_depth: int = 0
+    max_inline_depth: int = 0
+    seconds: float = 0.0
+    inline_seconds: float = 0.0
+
+
+class BlockCache:
+    # Parsed top level blocks keyed by their source text, plus their rendered
+    # fragments once somebody asked for them. Shared between parses of
+    # (versions of) the same documents, so an edit only costs the blocks it
+    # touched. Least recently used blocks are dropped beyond max_blocks.
+    # Safe to share between parsers in different threads.
+    max_blocks: int
+    _blocks: OrderedDict
+    # Same entries by node, to find the fragments of a parsed tree's blocks
+    _nodes: dict
+    _lock: Lock
+
+    def __init__(self: Self, max_blocks: int = 20000):
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+        self._nodes = {}
+        self._lock = Lock()
+
+    def __len__(self: Self) -> int:
+        return len(self._blocks)
+
+    def get(self: Self, key: tuple[bool, str]) -> Node | None:
+        with self._lock:
+            entry = self._blocks.get(key)
+            if entry is None:
+                return None
+            self._blocks.move_to_end(key)
+            return entry[0]
+
+    def put(self: Self, key: tuple[bool, str], node: Node) -> None:
+        with self._lock:
+            old_entry = self._blocks.get(key)
+            if old_entry is not None:
+                # Another thread parsed the same block in the meantime
+                del self._nodes[id(old_entry[0])]
+            self._blocks[key] = [node, None]
+            self._nodes[id(node)] = self._blocks[key]
+            while len(self._blocks) > self.max_blocks:
+                old_node = self._blocks.popitem(last=False)[1][0]
+                del self._nodes[id(old_node)]
+
+    # Same result as tree.fragments(), but blocks that were rendered before
+    # are taken from the cache
+    def fragments(self: Self, tree: Tree) -> list:
+        fragments = [Tree.open_tag]
+        for node in tree.children:
+            with self._lock:
+                entry = self._nodes.get(id(node))
+            if entry is None:
+                fragments += node.fragments()
+                continue
+            if entry[1] is None:
+                # Two threads may both render it, which is harmless
+                entry[1] = node.fragments()
+            fragments += entry[1]
+        fragments.append(Tree.close_tag)
+        return fragments
+
 
 class MarkdownParser:
     _index: int
     _data: str
+    _block_cache: BlockCache | None
+    _stats: ParserStats | None
+    # Only find out where blocks end, without parsing their content
+    _dry_run: bool
 
-    _stop_on_single_newline: bool = False
-    _inside_code_block: bool = False
+    # Caches for forward searches done while scanning a block, see _find()
+    _find_cache: dict
 
-    _inside_flags: dict = {
-        "italics": False,
-        "bold": False,
-        "strikethrough": False,
-        "inline_code": False,
-        "quote": False,
-        "link": False,
-        "media": False
-    }
+    def __init__(self: Self, block_cache: BlockCache | None = None, stats: ParserStats | None = None):
+        self._block_cache = block_cache
+        self._stats = stats
+        self._dry_run = False
 
+    # Every call works on its own copy of the parse state, so a single parser
+    # can be used from any number of threads at once
     def parse(self: Self, data: str):
+        if self._stats is None:
+            return copy(self)._parse_document(data)
+
+        start = perf_counter()
+        tree = copy(self)._parse_document(data)
+        self._stats.seconds += perf_counter() - start
+        self._stats.characters += len(data)
+        return tree
+
+    # Parses all sources, with up to workers threads, and returns the trees in
+    # the order of sources. Only really runs in parallel on free-threaded
+    # builds of Python, the result is the same as parsing them one by one.
+    def parse_many(self: Self, sources: Iterable[str], workers: int = 1) -> list[Tree]:
+        if workers <= 1:
+            return [self.parse(source) for source in sources]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.parse, sources))
+
+    def _parse_document(self: Self, data: str):
         self._data = data
         self._index = 0
 
@@ -46,24 +175,88 @@ class MarkdownParser:
         children: list[Node] = []
 
         while not self._is_eof():
-            self._reset_flags()
-
-            header_level = self._determine_header_level()
-            list_level = self._determine_list_indent_level()
-            if header_level > 0:
-                self._consume(header_level + 1)
-                children.append(self._parse_header(header_level))
-
-            # TODO that check is ugly
-            elif self._peek() == "`" and self._peek(1) == "`" and self._peek(2) == "`":
-                children.append(self._parse_code_block())
-            elif list_level > 0:
-                children.append(self._parse_unordered_list(list_level))
-            else:
-                children.append(self._parse_paragraph())
+            if self._stats is not None:
+                self._stats.blocks += 1
+            if self._block_cache is None:
+                children.append(self._parse_block())
+                continue
+
+            # Where a block ends only depends on newlines and line starts, so
+            # a dry run finds its extent cheaply. A block's content only
+            # depends on its own text (and whether it ends the document), so
+            # that is the cache key.
+            start_index = self._index
+            self._skip_block()
+            children.append(self._cached_block(start_index))
 
         return children
 
+    # Yields the top level blocks of the document in stream one by one, as
+    # soon as they are complete. Only the current block and one chunk of
+    # lookahead are held in memory. Gives the same blocks as parse().
+    def iter_blocks(self: Self, stream: TextIO, chunk_size: int = 65536) -> Iterator[Node]:
+        return copy(self)._iter_blocks(stream, chunk_size)
+
+    def _iter_blocks(self: Self, stream: TextIO, chunk_size: int) -> Iterator[Node]:
+        self._data = ""
+        self._index = 0
+        exhausted = False
+
+        while not (exhausted and self._is_eof()):
+            start_index = self._index
+            if not self._is_eof():
+                self._skip_block()
+            # Blocks look at most into the line after their end to decide
+            # where they end, so a block is complete once that line is
+            # complete. Otherwise it may still go on in the next chunk.
+            if not exhausted and (self._is_eof() or self._data.find("\n", self._index) < 0):
+                # Reading at least as much as is buffered keeps a huge block
+                # from being scanned over and over again
+                chunk = stream.read(max(chunk_size, len(self._data) - start_index))
+                exhausted = chunk == ""
+                self._data = self._data[start_index:] + chunk
+                self._index = 0
+                continue
+
+            if self._block_cache is None:
+                self._index = start_index
+                yield self._parse_block()
+            else:
+                yield self._cached_block(start_index)
+
+    # Moves the cursor to the end of the block without parsing its content
+    def _skip_block(self: Self) -> None:
+        self._dry_run = True
+        self._parse_block()
+        self._dry_run = False
+
+    # Takes the block between start_index and the cursor from the block cache
+    # or parses and adds it
+    def _cached_block(self: Self, start_index: int) -> Node:
+        key = (self._is_eof(), self._data[start_index:self._index])
+        node = self._block_cache.get(key)
+        if node is None:
+            self._index = start_index
+            node = self._parse_block()
+            self._block_cache.put(key, node)
+        elif self._stats is not None:
+            self._stats.cached_blocks += 1
+        return node
+
+    def _parse_block(self: Self) -> Node:
+        header_level = self._determine_header_level()
+        list_level = self._determine_list_indent_level()
+        if header_level > 0:
+            self._consume(header_level + 1)
+            return self._parse_header(header_level)
+
+        elif self._data.startswith("```", self._index):
+            return self._parse_code_block()
+        elif list_level > 0:
+            return self._parse_unordered_list(list_level)
+        else:
+            return self._parse_paragraph()
+
     # Figures out header level, returns 0 if it's not a header
     def _determine_header_level(self: Self) -> int:
         level = 0
@@ -100,29 +293,66 @@ class MarkdownParser:
         self._consume(2)
 
     def _parse_header(self: Self, level: int) -> HeaderNode:
-        self._stop_on_single_newline = True
-        children = self._parse_rich_text()
-        self._stop_on_single_newline = False
+        end_index = self._find_line_end()
+        children = self._parse_inline(self._index, end_index)
+        self._index = end_index + 1
         return HeaderNode(children, level)
 
     def _parse_paragraph(self: Self) -> ParagraphNode:
-        children = self._parse_rich_text()
+        search_index = self._index
+        while True:
+            end_index = self._data.find("\n", search_index)
+            if end_index < 0:
+                end_index = self._text_end()
+                next_index = len(self._data)
+                break
+
+            next_char = self._peek(end_index + 1 - self._index)
+            if next_char == "\n":
+                # It's a double newline -> new paragraph
+                next_index = end_index + 2
+                break
+            if next_char == "#" or next_char == "-":
+                # Next line starts with hash or dash -> potential heading or
+                # list
+                next_index = end_index + 1
+                break
+            search_index = end_index + 1
+
+        children = self._parse_inline(self._index, end_index)
+        self._index = next_index
         return ParagraphNode(children)
 
+    # Code is taken verbatim, the only thing to look for is the closing fence.
+    # The rest of the opening fence's line is the language.
     def _parse_code_block(self: Self) -> CodeBlockNode:
-        self._inside_code_block = True
         self._consume(3)
-        children = self._parse_rich_text()
-        self._inside_code_block = False
-        # TODO I don't actually want rich text in a code block
-        return CodeBlockNode(children)
+        end_index = self._data.find("\n```", self._index)
+        next_index = end_index + 4
+        if end_index < 0:
+            end_index = self._text_end()
+            next_index = len(self._data)
+
+        info_end = self._data.find("\n", self._index, end_index)
+        if info_end < 0:
+            info_end = end_index
+        language = self._data[self._index:info_end].strip()
+
+        children = []
+        if end_index > info_end + 1:
+            children.append(TextNode(self._data[info_end + 1:end_index]))
+        self._index = next_index
+        return CodeBlockNode(children, language)
 
     def _parse_unordered_list(self: Self, list_level: int) -> ListBlockNode:
+        if self._stats is not None:
+            self._stats.max_list_depth = max(self._stats.max_list_depth, list_level)
         self._consume_list_indent()
-        self._stop_on_single_newline = True
         children = []
         while True:
-            children.append(ListElementNode(self._parse_rich_text()))
+            end_index = self._find_line_end()
+            children.append(ListElementNode(self._parse_inline(self._index, end_index)))
+            self._index = end_index + 1
             new_list_level = self._determine_list_indent_level()
             if new_list_level < list_level:
                 break
@@ -131,201 +361,189 @@ class MarkdownParser:
             self._consume_list_indent()
         return ListBlockNode(children)
 
-    def _run_symmetric_content_rule(self: Self,
-                                    rule: tuple[str, str, Callable],
-                                    children: list[Node],
-                                    start_index: int,
-                                    end_index: int) -> (list[Node], int, bool):
-        for n, char in enumerate(rule[1]):
-            if char != self._peek(n):
-                return (children, start_index, False)
-
-        if self._inside_flags[rule[0]]:
-            return (children, start_index, True)
-
-        self._consume(len(rule[1]))
-        children.append(TextNode(self._data[start_index:end_index]))
-        children += self._parse_symmetric_rule(rule)
-        return (children, self._index, False)
-
-    def _run_asymmetric_content_rule(self: Self,
-                                     rule: tuple[str, str, str, Callable],
-                                     children: list[Node],
-                                     start_index: int,
-                                     end_index: int) -> (list[Node], int, bool):
-        should_exit_start = False
-        for n, char in enumerate(rule[1]):
-            if char != self._peek(n):
-                should_exit_start = True
-                break
-
-        should_exit_end = False
-        if self._inside_flags[rule[0]]:
-            for n, char in enumerate(rule[2]):
-                if char != self._peek(n):
-                    should_exit_end = True
-                    break
-
-            if not should_exit_end:
-                return (children, start_index, True)
-
-        if should_exit_start or should_exit_end:
-            return (children, start_index, False)
-
-        self._consume(len(rule[1]))
-        children.append(TextNode(self._data[start_index:end_index]))
-        children += self._parse_asymmetric_rule(rule)
-        return (children, self._index, False)
-
-    def _parse_rich_text(self: Self, in_recursion: bool = False) -> list[Node]:
-        children: list[Node] = []
-
-        start_index = self._index
-        end_index = self._index
-        while not self._is_eof():
-            end_index = self._index
-
-            # Rich content parsing
-
-            # italics, bold and combination need to be handled specially due
-            # to potential nesting
-            if not self._inside_code_block:
-                if self._peek() == "*":
-                    # One asterisk -> italics
-
-                    if self._peek(1) == "*":
-                        # Two asterisks -> bold
-                        # _parse_bold() handles triple asterisk for both
-                        if self._inside_flags["bold"]:
-                            break
-
-                        self._consume(2)
-                        children.append(
-                            TextNode(self._data[start_index:end_index]))
-                        children += self._parse_bold()
-                        start_index = self._index
-
-                    else:
-                        if self._inside_flags["italics"]:
-                            break
-
-                        self._consume()
-                        children.append(
-                            TextNode(self._data[start_index:end_index]))
-                        children += self._parse_symmetric_rule(
-                            ("italics", "*", ItalicsNode))
-                        start_index = self._index
-
-                # regular rich content rules
-                rules = [
-                    ("inline_code", "`", InlineCodeNode),
-                    ("strikethrough", "~~", StrikethroughNode),
-                    ("link", "[", ")", LinkNode),
-                    ("media", "![", ")", MediaNode)
-                ]
-
-                should_break = False
-                for rule in rules:
-                    if len(rule) == 3:
-                        (children, start_index, should_break) = self._run_symmetric_content_rule(
-                            rule, children, start_index, end_index)
-                    if len(rule) == 4:
-                        (children, start_index, should_break) = self._run_asymmetric_content_rule(
-                            rule, children, start_index, end_index)
-                    if should_break:
-                        break
-
-                if should_break:
-                    break
-
-            # Conditions for ending current block on newline
-            if self._peek() == "\n":
-                # We reached the end of line
-                if self._inside_code_block:
-                    if self._peek(1) == "`" and self._peek(2) == "`" and self._peek(3) == "`":
-                        if not in_recursion:
-                            self._consume(4)
-                        break
-                else:
-                    if self._stop_on_single_newline:
-                        if not in_recursion:
-                            # If we're deeper in recursion we mustn't consume
-                            # the line end, otherwise our start of recursion
-                            # stack will not know the line ended and will blend
-                            # lines together. Same as with the checks below
-                            self._consume()
-                        break
-
-                    if self._peek(1) == "\n":
-                        # It's a double newline -> new paragraph
-                        if not in_recursion:
-                            self._consume(2)
-                        break
-
-                    if self._peek(1) == "#":
-                        # Next line starts with hash -> potential heading
-                        if not in_recursion:
-                            self._consume()
-                        break
-                    if self._peek(1) == "-":
-                        # Next line starts with dash -> potential list
-                        if not in_recursion:
-                            self._consume()
-                        break
-
-            self._consume()
-
-        if end_index > start_index:
-            text = self._data[start_index:end_index]
-            children.append(TextNode(text))
+    def _parse_inline(self: Self, start_index: int, end_index: int) -> list[Node]:
+        if self._dry_run:
+            return []
+        if self._stats is None:
+            return self._scan_inline(start_index, end_index)
+
+        start = perf_counter()
+        children = self._scan_inline(start_index, end_index)
+        self._stats.inline_seconds += perf_counter() - start
+        # Counted separately to keep the loop in _scan_inline lean
+        self._stats.inline_characters += end_index - start_index
+        self._stats.inline_tokens += len(_inline_tokens.findall(self._data, start_index, end_index))
         return children
 
-    def _parse_bold(self: Self) -> list[Node]:
-        self._inside_flags["bold"] = True
-        children: list[Node] = []
-        if self._peek() == "*":
-            # If there is a third asterisk, also add italics
-            self._consume()
-            children = self._parse_symmetric_rule(("italics", "*", ItalicsNode))
-
-        children += self._parse_rich_text(True)
-
-        if self._match("**"):
-            self._inside_flags["bold"] = False
-            return [BoldNode(children)]
-
-        return [TextNode("**")] + children
-
-    # regular content rule parser
-    def _parse_symmetric_rule(self: Self, rule: tuple[str, str, Node]) -> list[Node]:
-        self._inside_flags[rule[0]] = True
-        children = self._parse_rich_text(True)
-
-        if self._match(rule[1]):
-            self._inside_flags[rule[0]] = False
-            return [rule[2](children)]
+    # Inline markup is parsed with a stack of open frames. Openers push a
+    # frame, closers pop every frame above their opener and build the node,
+    # frames that never get closed turn back into their marker text. Every
+    # kind of frame can only be open once at a time, so the stack stays tiny
+    # and each character of the block is looked at a constant number of times
+    # no matter how many markers are left unmatched.
+    def _scan_inline(self: Self, start_index: int, end_index: int) -> list[Node]:
+        data = self._data
+        self._find_cache = {}
+        root: list[Node] = []
+        stack: list[_Frame] = []
+        children = root
+
+        text_start = start_index
+        index = start_index
+        while True:
+            match = _inline_tokens.search(data, index, end_index)
+            if match is None:
+                break
 
-        return [TextNode(rule[1])] + children
+            token = match.group()
+            token_start = match.start()
+            index = match.end()
+
+            if token[0] == "*":
+                if token_start > text_start:
+                    children.append(TextNode(data[text_start:token_start]))
+                text_start = index
+                children = self._handle_stars(stack, root, len(token))
+            elif token in _symmetric_rules:
+                if token_start > text_start:
+                    children.append(TextNode(data[text_start:token_start]))
+                text_start = index
+                kind, node_type = _symmetric_rules[token]
+                children = self._toggle_frame(stack, root, kind, token, node_type)
+            else:
+                # Links and media are atoms, their content is taken verbatim
+                # up to the first closing parenthesis
+                node = self._parse_reference(token, index, end_index)
+                if node is None:
+                    # Not a valid link, the bracket is just text
+                    if self._stats is not None:
+                        self._stats.fallbacks += 1
+                    continue
+
+                if token_start > text_start:
+                    children.append(TextNode(data[text_start:token_start]))
+                children.append(node)
+                index = self._find(")", index, end_index) + 1
+                text_start = index
+
+        if end_index > text_start:
+            children.append(TextNode(data[text_start:end_index]))
+
+        # Whatever is still open at the end of the block was never closed
+        while stack:
+            self._drop_frame(stack, root)
+        return root
+
+    def _handle_stars(self: Self, stack: list[_Frame], root: list[Node], count: int) -> list[Node]:
+        children = stack[-1].children if stack else root
+        while count > 0:
+            innermost = None
+            bold_open = False
+            for frame in stack:
+                if frame.kind == "italics" or frame.kind == "bold":
+                    innermost = frame.kind
+                    bold_open = bold_open or frame.kind == "bold"
+
+            if innermost == "italics" and (count == 1 or bold_open):
+                # A single star closes italics, so does the first star of
+                # "***" when closing bold and italics together
+                marker = "*"
+            elif count >= 2:
+                marker = "**"
+            else:
+                marker = "*"
 
-    def _parse_asymmetric_rule(self: Self, rule: tuple[str, str, str, Node]) -> list[Node]:
-        self._inside_flags[rule[0]] = True
-        children = self._parse_rich_text(True)
+            kind, node_type = _star_rules[marker]
+            children = self._toggle_frame(stack, root, kind, marker, node_type)
+            count -= len(marker)
+        return children
 
-        # TODO I need matching here to check for "internal structure"
-        # eg: links need exactly one "](" inside to be valid
-        # I can't do the check in the node constructor otherwise
-        # I can't properly insert incorrect syntax back into the HTML
-        if self._match(rule[2]):
-            self._inside_flags[rule[0]] = False
-            return [rule[3](children)]
+    def _toggle_frame(self: Self,
+                      stack: list[_Frame],
+                      root: list[Node],
+                      kind: str,
+                      marker: str,
+                      node_type: type) -> list[Node]:
+        for position, frame in enumerate(stack):
+            if frame.kind == kind:
+                break
+        else:
+            frame = _Frame(kind, marker, node_type, [])
+            stack.append(frame)
+            if self._stats is not None:
+                self._stats.max_inline_depth = max(self._stats.max_inline_depth, len(stack))
+            return frame.children
+
+        # Anything opened after us can't be closed anymore
+        while len(stack) > position + 1:
+            self._drop_frame(stack, root)
+
+        stack.pop()
+        children = stack[-1].children if stack else root
+        children.append(frame.node_type(frame.children))
+        return children
 
-        return [TextNode(rule[1])] + children
+    def _drop_frame(self: Self, stack: list[_Frame], root: list[Node]) -> None:
+        if self._stats is not None:
+            self._stats.fallbacks += 1
+        frame = stack.pop()
+        children = stack[-1].children if stack else root
+        children.append(TextNode(frame.marker))
+        children += frame.children
+
+    def _parse_reference(self: Self, token: str, start_index: int, end_index: int) -> Node | None:
+        close_index = self._find(")", start_index, end_index)
+        if close_index < 0:
+            return None
+
+        # Link and media need exactly one "](" between brackets and source
+        split_index = self._find("](", start_index, end_index)
+        if split_index < 0 or split_index >= close_index:
+            return None
+        if 0 <= self._find("](", split_index + 1, end_index, "second ](") < close_index:
+            return None
+
+        content = [TextNode(self._data[start_index:close_index])]
+        if token == "[":
+            return LinkNode(content)
+        return MediaNode(content)
+
+    # str.find() that remembers its last result per needle (or slot, for
+    # searches of the same needle from a different position). The scan only
+    # ever moves forward, so as long as we search from before the previous hit
+    # it is still the next occurrence. This keeps runs of unmatched brackets
+    # from searching the rest of the block over and over again.
+    def _find(self: Self, needle: str, start_index: int, end_index: int, slot: str = "") -> int:
+        slot = slot or needle
+        cached = self._find_cache.get(slot)
+        if cached is not None:
+            cached_start, found_index = cached
+            if cached_start <= start_index and (found_index < 0 or start_index <= found_index):
+                return found_index
+
+        found_index = self._data.find(needle, start_index, end_index)
+        self._find_cache[slot] = (start_index, found_index)
+        return found_index
+
+    def _find_line_end(self: Self) -> int:
+        end_index = self._data.find("\n", self._index)
+        if end_index < 0:
+            return self._text_end()
+        return end_index
+
+    # End of the text at EOF, a trailing newline isn't part of the last block
+    def _text_end(self: Self) -> int:
+        if self._data.endswith("\n"):
+            return len(self._data) - 1
+        return len(self._data)
 
     # helpers
     def _is_eof(self: Self) -> bool:
         return self._index >= len(self._data)
 
     def _consume(self: Self, n: int = 1) -> str:
+        if self._stats is not None:
+            self._stats.consumes += 1
         if self._is_eof():
             return "\0"
 
@@ -345,19 +563,9 @@ class MarkdownParser:
         return True
 
     def _peek(self: Self, n: int = 0) -> str:
+        if self._stats is not None:
+            self._stats.peeks += 1
         if self._index + n >= len(self._data):
             return '\0'
 
         return self._data[self._index + n]
-
-    def _reset_flags(self: Self):
-        self._stop_on_single_newline = False
-        self._inside_code_block = False
-
-        self._inside_flags["italics"] = False
-        self._inside_flags["bold"] = False
-        self._inside_flags["strikethrough"] = False
-        self._inside_flags["inline_code"] = False
-        self._inside_flags["quote"] = False
-        self._inside_flags["link"] = False
-        self._inside_flags["media"] = False
@@ -1,42 +1,153 @@
+import re
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import Self
+from array import array
+from dataclasses import dataclass, replace
+from html import escape
+from typing import Self, Callable, ClassVar
 from os.path import splitext
 
 _media_base_path = "media/"
 _external_media_base_path = "https://lprod.dev/blog/media/"
+# Images are at most 65% of the 1600px wide content, see blog_theme.css
+_media_sizes = "(max-width: 1600px) 65vw, 1040px"
+_word = re.compile(r"\S+")
+
+# Size and resized copies of the images in blog/media by file name, see
+# media.py. Filled in before anything gets rendered, images that aren't in
+# here are emitted as they are.
+media_images: dict = {}
+# Fingerprinted name of the files in blog/media by their plain one, files
+# that aren't in here are linked to by their plain name
+media_names: dict = {}
+
+
+# Anything that takes string fragments: file.write, StringIO.write or the
+# append of a list that gets joined afterwards
+Sink = Callable[[str], object]
+
+
+def use_media(images: dict, names: dict) -> None:
+    media_images.clear()
+    media_images.update(images)
+    media_names.clear()
+    media_names.update(names)
+
+
+# Renders fragments collected by Tree.fragments() for one output variant.
+# Plain strings are shared between all variants, only the nodes that depend
+# on the variant are rendered again.
+def write_fragments(fragments: list, write: Sink, external: bool) -> None:
+    for fragment in fragments:
+        if type(fragment) is str:
+            write(fragment)
+        else:
+            fragment.render(write, external)
+
+
+# Runs render with external=None and returns the output shared by all variants
+# as joined strings, with the variant dependent nodes left in between
+def collect_fragments(render: Callable[[Sink, bool | None], None]) -> list:
+    fragments = []
+    pending = []
+
+    def collect(fragment) -> None:
+        if type(fragment) is str:
+            pending.append(fragment)
+            return
+        if pending:
+            fragments.append("".join(pending))
+            pending.clear()
+        fragments.append(fragment)
+
+    render(collect, None)
+    if pending:
+        fragments.append("".join(pending))
+    return fragments
 
 
 class Node(ABC):
+    # Without this every slotted subclass would still get a __dict__
+    __slots__ = ()
 
     @abstractmethod
     def dump(self: Self, indent: int = 0) -> str:
         pass
 
+    # external is None while collecting fragments, nodes that render
+    # differently per variant then write themselves instead of their HTML
+    @abstractmethod
+    def render(self: Self, write: Sink, external: bool | None) -> None:
+        pass
+
+    def html(self: Self, external: bool) -> str:
+        fragments = []
+        self.render(fragments.append, external)
+        return "".join(fragments)
+
+    def fragments(self: Self) -> list:
+        return collect_fragments(self.render)
 
-@dataclass
+
+@dataclass(slots=True)
 class Tree:
     children: list[Node]
 
+    open_tag: ClassVar[str] = "<html>\n"
+    close_tag: ClassVar[str] = "\n</html>\n"
+
     def dump(self: Self) -> str:
         out = ""
         for child in self.children:
             out += child.dump(0)
         return out
 
-    def html(self: Self, external: bool = False) -> str:
-        out = "<html>\n"
+    def render(self: Self, write: Sink, external: bool = False) -> None:
+        write(self.open_tag)
+        self.render_body(write, external)
+        write(self.close_tag)
+
+    # Only the blocks, without the <html> wrapper, for embedding in feeds
+    def render_body(self: Self, write: Sink, external: bool = False) -> None:
         for child in self.children:
-            out += child.html(external)
-        return out + "\n</html>\n"
+            child.render(write, external)
+
+    def html(self: Self, external: bool = False) -> str:
+        fragments = []
+        self.render(fragments.append, external)
+        return "".join(fragments)
+
+    # Copy of the tree cut off after max_words words or max_blocks top level
+    # blocks, whichever comes first. Nodes are cut as a whole, so inline
+    # markup that was open at the cut still gets closed. Returns the copy and
+    # the number of words in it.
+    def excerpt(self: Self, max_words: int, max_blocks: int) -> tuple[Self, int]:
+        children = []
+        words = 0
+        for child in self.children[:max_blocks]:
+            part, part_words, complete = _truncate(child, max_words - words)
+            if part is not None:
+                children.append(part)
+            words += part_words
+            if not complete:
+                break
+        return Tree(children), words
+
+    # Walks the tree once and returns the output shared by all variants as
+    # joined strings, with the variant dependent nodes left in between. Use
+    # write_fragments() to turn them into any number of variants.
+    def fragments(self: Self) -> list:
+        return collect_fragments(self.render)
 
 # Block Nodes
 
 
-@dataclass
+@dataclass(slots=True)
 class ParagraphNode(Node):
     children: list[Node]
 
+    open_tag: ClassVar[str] = "<p>"
+    close_tag: ClassVar[str] = "</p>\n\n"
+
     def dump(self: Self, indent: int) -> str:
         out = (" " * 4 * indent) + "Paragraph Node\n"
         for child in self.children:
@@ -44,54 +155,66 @@ class ParagraphNode(Node):
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = "<p>"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.open_tag)
         for child in self.children:
-            out += child.html(external)
-        return out + "</p>\n\n"
+            child.render(write, external)
+        write(self.close_tag)
 
 
-@dataclass
+@dataclass(slots=True)
 class CodeBlockNode(Node):
+    # The code as a single text node, exactly as it was in the source
     children: list[Node]
+    language: str = ""
+
+    open_tag: ClassVar[str] = "<pre>\n"
+    close_tag: ClassVar[str] = "\n</pre>\n"
 
     def dump(self: Self, indent: int) -> str:
-        out = (" " * 4 * indent) + "Code Block Node\n"
+        out = (" " * 4 * indent) + f"Code Block Node: {self.language}\n"
         for child in self.children:
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = "<pre>\n"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.language_tag(self.language))
         for child in self.children:
-            out += child.html(external).strip()
-            # WARNING does strip have side effects here?
-        return out + "\n</pre>\n"
+            write(escape(child.html(external), quote=False))
+        write(self.close_tag)
 
+    @classmethod
+    def language_tag(cls, language: str) -> str:
+        if language == "":
+            return cls.open_tag
+        return f"<pre class=\"language-{escape(language)}\">\n"
 
-@dataclass
+
+@dataclass(slots=True)
 class ListBlockNode(Node):
     children: list[Node]
     type: str = "unordered"
 
+    open_tag: ClassVar[str] = "<ul>\n"
+    close_tag: ClassVar[str] = "\n</ul>\n"
+
     def dump(self: Self, indent: int) -> str:
         out = (" " * 4 * indent) + "List Block Node\n"
         for child in self.children:
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = ""
+    def render(self: Self, write: Sink, external: bool) -> None:
         if self.type == "unordered":
-            out = "<ul>\n"
+            write(self.open_tag)
             for child in self.children:
-                out += child.html(external)
-        return out + "\n</ul>\n"
+                child.render(write, external)
+        write(self.close_tag)
 
 # Inline Nodes
 
 
-@dataclass
+@dataclass(slots=True)
 class HeaderNode(Node):
     children: list[Node]
     level: int
@@ -102,101 +225,116 @@ class HeaderNode(Node):
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = f"<h{self.level}>"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(f"<h{self.level}>")
         for child in self.children:
-            out += child.html(external)
-        return out + f"</h{self.level}>\n\n"
+            child.render(write, external)
+        write(f"</h{self.level}>\n\n")
 
 
-@dataclass
+@dataclass(slots=True)
 class InlineCodeNode(Node):
     children: list[Node]
 
+    open_tag: ClassVar[str] = "<code>"
+    close_tag: ClassVar[str] = "</code>"
+
     def dump(self: Self, indent: int) -> str:
         out = (" " * 4 * indent) + "Inline Code Node\n"
         for child in self.children:
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = "<code>"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.open_tag)
         for child in self.children:
-            out += child.html(external)
-        return out + "</code>"
+            child.render(write, external)
+        write(self.close_tag)
 
 
-@dataclass
+@dataclass(slots=True)
 class ListElementNode(Node):
     children: list[Node]
 
+    open_tag: ClassVar[str] = "<li>"
+    close_tag: ClassVar[str] = "</li>"
+
     def dump(self: Self, indent: int) -> str:
         out = (" " * 4 * indent) + "List Element Node\n"
         for child in self.children:
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = "<li>"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.open_tag)
         for child in self.children:
-            out += child.html(external)
-        return out + "</li>"
+            child.render(write, external)
+        write(self.close_tag)
 
 
-@dataclass
+@dataclass(slots=True)
 class StrikethroughNode(Node):
     children: list[Node]
 
+    open_tag: ClassVar[str] = "<s>"
+    close_tag: ClassVar[str] = "</s>"
+
     def dump(self: Self, indent: int) -> str:
         out = (" " * 4 * indent) + "Strikethrough Node\n"
         for child in self.children:
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = "<s>"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.open_tag)
         for child in self.children:
-            out += child.html(external)
-        return out + "</s>"
+            child.render(write, external)
+        write(self.close_tag)
 
 
-@dataclass
+@dataclass(slots=True)
 class ItalicsNode(Node):
     children: list[Node]
 
+    open_tag: ClassVar[str] = "<i>"
+    close_tag: ClassVar[str] = "</i>"
+
     def dump(self: Self, indent: int) -> str:
         out = (" " * 4 * indent) + "Italics Node\n"
         for child in self.children:
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = "<i>"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.open_tag)
         for child in self.children:
-            out += child.html(external)
-        return out + "</i>"
+            child.render(write, external)
+        write(self.close_tag)
 
 
-@dataclass
+@dataclass(slots=True)
 class BoldNode(Node):
     children: list[Node]
 
+    open_tag: ClassVar[str] = "<b>"
+    close_tag: ClassVar[str] = "</b>"
+
     def dump(self: Self, indent: int) -> str:
         out = (" " * 4 * indent) + "Bold Node\n"
         for child in self.children:
             out += child.dump(indent + 1)
         return out
 
-    def html(self: Self, external: bool) -> str:
-        out = "<b>"
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.open_tag)
         for child in self.children:
-            out += child.html(external)
-        return out + "</b>"
+            child.render(write, external)
+        write(self.close_tag)
 
 # Leaf Nodes
 
 
-@dataclass
+@dataclass(slots=True)
 class MediaNode(Node):
     type: str
     source: str
@@ -218,22 +356,42 @@ class MediaNode(Node):
         return (" " * 4 * indent) + f"""Media Node:
             {self.type} - {self.source} - {self.text}\n"""
 
+    def render(self: Self, write: Sink, external: bool | None) -> None:
+        if external is None:
+            # Depends on the base path, defer until the variant is known
+            write(self)
+            return
+        write(self.html(external))
+
     def html(self: Self, external: bool) -> str:
         base_path = _media_base_path
         if external:
             base_path = _external_media_base_path
         if self.type == "image":
-            out = f"<img src=\"{base_path + self.source}\" alt=\"{self.text}\"></img>"
+            out = f"<img {self.image_attributes(base_path)} loading=\"lazy\" decoding=\"async\"></img>"
         elif self.type == "video":
-            out = f"""<video controls>
-            <source src=\"{base_path + self.source}\"/>
+            out = f"""<video controls preload=\"metadata\">
+            <source src=\"{base_path + media_names.get(self.source, self.source)}\"/>
             Video tag unsupported!</video>"""
         if self.text != "":
             out += f"<label class=\"media-caption\">{self.text}</label>"
         return out
 
-
-@dataclass
+    def image_attributes(self: Self, base_path: str) -> str:
+        source = base_path + media_names.get(self.source, self.source)
+        attributes = f"src=\"{source}\" alt=\"{self.text}\""
+        info = media_images.get(self.source)
+        if info is None:
+            return attributes
+        if info.derivatives:
+            candidates = [f"{base_path + file_name} {width}w" for width, file_name in sorted(info.derivatives.items())]
+            candidates.append(f"{source} {info.width}w")
+            attributes += f" srcset=\"{', '.join(candidates)}\" sizes=\"{_media_sizes}\""
+        # Lets the browser reserve the space before the image is loaded
+        return attributes + f" width=\"{info.width}\" height=\"{info.height}\""
+
+
+@dataclass(slots=True)
 class LinkNode(Node):
     source: str
     text: str
@@ -248,16 +406,225 @@ class LinkNode(Node):
     def dump(self: Self, indent: int) -> str:
         return (" " * 4 * indent) + f"Link Node: {self.source}, {self.text}\n"
 
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.html(external))
+
     def html(self: Self, external: bool) -> str:
         return f"<a href=\"{self.source}\">{self.text}</a>"
 
 
-@dataclass
+@dataclass(slots=True)
 class TextNode:
     text: str
 
     def dump(self: Self, indent: int) -> str:
         return (" " * 4 * indent) + "Text Node: \"" + self.text + "\"\n"
 
+    def render(self: Self, write: Sink, external: bool) -> None:
+        write(self.text)
+
     def html(self: Self, external: bool) -> str:
         return self.text
+
+
+# Returns the part of node that fits into budget words, the words it uses and
+# whether it's all of node. Links and media are never cut in half.
+def _truncate(node, budget: int) -> tuple[Node | None, int, bool]:
+    kind = type(node)
+    if kind is TextNode:
+        ends = [match.end() for match in _word.finditer(node.text)]
+        if len(ends) <= budget:
+            return node, len(ends), True
+        if budget == 0:
+            return None, 0, False
+        return TextNode(node.text[:ends[budget - 1]] + "…"), budget, False
+    if kind is LinkNode or kind is MediaNode:
+        words = len(node.text.split())
+        if words > budget:
+            return None, 0, False
+        return node, words, True
+
+    children = []
+    words = 0
+    for child in node.children:
+        part, part_words, complete = _truncate(child, budget - words)
+        if part is not None:
+            children.append(part)
+        words += part_words
+        if not complete:
+            if not children:
+                return None, words, False
+            return replace(node, children=children), words, False
+    return node, words, True
+
+
+# Flat tree representation
+
+_flat_kinds = (
+    ParagraphNode,
+    CodeBlockNode,
+    ListBlockNode,
+    HeaderNode,
+    InlineCodeNode,
+    ListElementNode,
+    StrikethroughNode,
+    ItalicsNode,
+    BoldNode,
+    MediaNode,
+    LinkNode,
+    TextNode
+)
+_flat_kind_ids = {kind: n for n, kind in enumerate(_flat_kinds)}
+
+
+class FlatTree:
+    # Compact alternative to Tree for keeping many documents around. Nodes are
+    # stored in document order in parallel arrays, children follow their
+    # parent directly and subtree_ends points past a node's last descendant.
+    # Text, links and media only store a span into the source they were
+    # parsed from instead of their own copy of the text, code blocks the span
+    # of their language.
+    __slots__ = ("source", "kinds", "parents", "subtree_ends", "starts", "ends", "levels")
+
+    source: str
+    kinds: array
+    parents: array
+    subtree_ends: array
+    starts: array
+    ends: array
+    # Header level, 0 for every other node
+    levels: array
+
+    def __init__(self: Self, source: str):
+        self.source = source
+        self.kinds = array("B")
+        self.parents = array("i")
+        self.subtree_ends = array("i")
+        self.starts = array("i")
+        self.ends = array("i")
+        self.levels = array("B")
+
+    @classmethod
+    def from_tree(cls, tree: Tree, source: str) -> Self:
+        flat = cls(source)
+        # Texts show up in the tree in the same order as in the source, so
+        # each one is found by searching forward from the end of the last
+        cursor = 0
+        stack = [(child, -1) for child in reversed(tree.children)]
+        while stack:
+            node, parent = stack.pop()
+            if node is None:
+                # Marker for the end of the subtree of parent
+                flat.subtree_ends[parent] = len(flat.kinds)
+                continue
+
+            index = len(flat.kinds)
+            kind = type(node)
+            flat.kinds.append(_flat_kind_ids[kind])
+            flat.parents.append(parent)
+            flat.subtree_ends.append(index + 1)
+            flat.levels.append(node.level if kind is HeaderNode else 0)
+
+            if kind is TextNode or kind is LinkNode or kind is MediaNode:
+                if kind is TextNode:
+                    text = node.text
+                else:
+                    text = node.text + "](" + node.source
+                start = source.find(text, cursor)
+                if start < 0:
+                    raise ValueError("Tree was not parsed from this source")
+                cursor = start + len(text)
+                flat.starts.append(start)
+                flat.ends.append(cursor)
+                continue
+
+            if kind is CodeBlockNode and node.language != "":
+                start = source.find(node.language, cursor)
+                if start < 0:
+                    raise ValueError("Tree was not parsed from this source")
+                cursor = start + len(node.language)
+                flat.starts.append(start)
+                flat.ends.append(cursor)
+            else:
+                flat.starts.append(0)
+                flat.ends.append(0)
+            stack.append((None, index))
+            stack += [(child, index) for child in reversed(node.children)]
+        return flat
+
+    def __len__(self: Self) -> int:
+        return len(self.kinds)
+
+    def text(self: Self, index: int) -> str:
+        return self.source[self.starts[index]:self.ends[index]]
+
+    def children(self: Self, index: int) -> list[int]:
+        children = []
+        child = index + 1
+        while child < self.subtree_ends[index]:
+            children.append(child)
+            child = self.subtree_ends[child]
+        return children
+
+    def to_tree(self: Self) -> Tree:
+        return Tree([self._node(child) for child in self._roots()])
+
+    def render(self: Self, write: Sink, external: bool = False) -> None:
+        write(Tree.open_tag)
+        # Closing tags of the open nodes, with the index their subtree ends at
+        closing = []
+        source = self.source
+        code_block = _flat_kind_ids[CodeBlockNode]
+        for index, kind_id in enumerate(self.kinds):
+            while closing and closing[-1][0] <= index:
+                write(closing.pop()[1])
+
+            kind = _flat_kinds[kind_id]
+            if kind is TextNode:
+                text = source[self.starts[index]:self.ends[index]]
+                if self.parents[index] >= 0 and self.kinds[self.parents[index]] == code_block:
+                    # Code block content, see CodeBlockNode.render()
+                    text = escape(text, quote=False)
+                write(text)
+            elif kind is LinkNode or kind is MediaNode:
+                self._node(index).render(write, external)
+            elif kind is HeaderNode:
+                write(f"<h{self.levels[index]}>")
+                closing.append((self.subtree_ends[index], f"</h{self.levels[index]}>\n\n"))
+            elif kind is CodeBlockNode:
+                write(CodeBlockNode.language_tag(self.text(index)))
+                closing.append((self.subtree_ends[index], kind.close_tag))
+            else:
+                write(kind.open_tag)
+                closing.append((self.subtree_ends[index], kind.close_tag))
+
+        while closing:
+            write(closing.pop()[1])
+        write(Tree.close_tag)
+
+    def html(self: Self, external: bool = False) -> str:
+        fragments = []
+        self.render(fragments.append, external)
+        return "".join(fragments)
+
+    def _roots(self: Self) -> list[int]:
+        roots = []
+        index = 0
+        while index < len(self.kinds):
+            roots.append(index)
+            index = self.subtree_ends[index]
+        return roots
+
+    def _node(self: Self, index: int) -> Node:
+        kind = _flat_kinds[self.kinds[index]]
+        if kind is TextNode:
+            return TextNode(self.text(index))
+        if kind is LinkNode or kind is MediaNode:
+            return kind([TextNode(self.text(index))])
+
+        children = [self._node(child) for child in self.children(index)]
+        if kind is HeaderNode:
+            return HeaderNode(children, self.levels[index])
+        if kind is CodeBlockNode:
+            return CodeBlockNode(children, self.text(index))
+        return kind(children)
@@ -0,0 +1,247 @@
+import json
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from hashlib import sha256
+from io import BytesIO
+from os import makedirs, remove, scandir
+from os.path import basename, getsize, isdir, isfile, join, splitext
+from typing import Iterable, Self
+
+from assets import AssetManifest, list_assets
+from outputs import load_state, save_state, write_atomic
+
+# Pillow is optional. Without it images still get their intrinsic size, read
+# straight from the file header, but no resized copies.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Format of the cache file, see save_state(). 2 since resized copies that
+# aren't smaller than the original are dropped.
+_cache_format = 2
+# Resized copies are only made for the widths well below that of the
+# original, srcset falls back to the original for everything wider
+_derivative_widths = (480, 960, 1440)
+_max_derivative_scale = 0.8
+# Relative to the media directory, resized copies are served from there too
+_derivatives_dir = "derived"
+_image_formats = {".png": "PNG", ".jpg": "JPEG"}
+_save_options = {
+    "PNG": {"optimize": True},
+    "JPEG": {"quality": 82, "optimize": True, "progressive": True}
+}
+# Start of frame markers, the ones that carry the image size
+_jpeg_frame_markers = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+@dataclass(slots=True)
+class ImageInfo:
+    width: int
+    height: int
+    # File name of each resized copy relative to the media directory, by
+    # width. None until Pillow got to make them.
+    derivatives: dict[int, str] | None = None
+
+    @classmethod
+    def from_dict(cls, info: dict) -> Self:
+        derivatives = info.get("derivatives")
+        if derivatives is not None:
+            # JSON only has string keys
+            derivatives = {int(width): file_name for width, file_name in derivatives.items()}
+        return cls(info["width"], info["height"], derivatives)
+
+
+# Size of a PNG or JPEG from its header, without decoding any pixels. None
+# for anything else.
+def image_size(path: str) -> tuple[int, int] | None:
+    with open(path, "rb") as image_reader:
+        header = image_reader.read(24)
+        if header.startswith(b"\x89PNG\r\n\x1a\n") and header[12:16] == b"IHDR":
+            return struct.unpack(">II", header[16:24])
+        if not header.startswith(b"\xff\xd8"):
+            return None
+
+        # Walk the JPEG segments up to the first frame header
+        image_reader.seek(2)
+        while True:
+            marker = image_reader.read(4)
+            if len(marker) < 4 or marker[0] != 0xFF:
+                return None
+            if marker[1] == 0xFF:
+                # Fill byte in front of the actual marker
+                image_reader.seek(-3, 1)
+                continue
+            length = int.from_bytes(marker[2:4], "big")
+            if marker[1] in _jpeg_frame_markers:
+                frame = image_reader.read(5)
+                if len(frame) < 5:
+                    return None
+                height, width = struct.unpack(">HH", frame[1:5])
+                return width, height
+            image_reader.seek(length - 2, 1)
+
+
+# Makes the resized copies of one image that aren't on disk yet. Copies that
+# don't come out smaller than the original are dropped, e.g. an optimized PNG
+# can grow when it's resampled. Returns the kept copies by width and the
+# paths of the ones that were written. Runs in the worker processes.
+def _make_derivatives(media_path: str, name: str, digest: str) -> tuple[dict[int, str], list[str]]:
+    stem, extension = splitext(name)
+    image_format = _image_formats[extension]
+    original_size = getsize(join(media_path, name))
+    derivatives = {}
+    written = []
+    with Image.open(join(media_path, name)) as image:
+        if image.mode == "P":
+            # Palette images can only be resized without filtering
+            image = image.convert("RGBA")
+        for width in _derivative_widths:
+            if width > image.width * _max_derivative_scale:
+                break
+            # The content hash in the name keeps copies of a replaced image
+            # from being picked up for the new one
+            file_name = f"{_derivatives_dir}/{stem}-{digest[:16]}-{width}{extension}"
+            path = join(media_path, file_name)
+            if isfile(path):
+                # Copies that aren't smaller are pruned with the unused ones
+                if getsize(path) < original_size:
+                    derivatives[width] = file_name
+                continue
+
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+            if image_format == "JPEG" and resized.mode != "RGB":
+                resized = resized.convert("RGB")
+            encoded = BytesIO()
+            resized.save(encoded, image_format, **_save_options[image_format])
+            if encoded.tell() >= original_size:
+                continue
+            write_atomic(path, encoded.getvalue())
+            derivatives[width] = file_name
+            written.append(path)
+    return derivatives, written
+
+
+class MediaLibrary:
+    # Intrinsic size and resized copies of every image in media_path. What
+    # the last build found out is cached by content hash, so every image is
+    # only measured and resized once. With fingerprint set every file in
+    # media_path and every stylesheet gets a copy named after its content
+    # hash, which the pages link to instead, so they can be cached forever.
+    media_path: str
+    cache_path: str
+    assets: AssetManifest
+    fingerprint: bool
+    # ImageInfo by file name relative to media_path
+    images: dict[str, ImageInfo]
+    # ImageInfo by content hash
+    cache: dict[str, ImageInfo]
+    # Name to link to by file name, both relative to media_path
+    names: dict[str, str]
+    # Path to link to by path of every stylesheet
+    stylesheets: dict[str, str]
+
+    def __init__(self: Self, media_path: str, cache_path: str, assets: AssetManifest, fingerprint: bool = False):
+        self.media_path = media_path
+        self.cache_path = cache_path
+        self.assets = assets
+        self.fingerprint = fingerprint
+        self.images = {}
+        self.cache = {}
+        self.names = {}
+        self.stylesheets = {}
+
+    def load(self: Self) -> None:
+        cache = load_state(self.cache_path, _cache_format)
+        # Without a cache every image is simply measured again
+        if cache is not None:
+            self.cache = {digest: ImageInfo.from_dict(info) for digest, info in cache.get("images", {}).items()}
+
+    def save(self: Self) -> None:
+        save_state(self.cache_path, {"images": {digest: asdict(info) for digest, info in self.cache.items()}},
+                   _cache_format)
+
+    # Identifies everything about the media that ends up in the pages
+    def digest(self: Self) -> str:
+        media = {
+            "images": {name: asdict(info) for name, info in self.images.items()},
+            "names": self.names,
+            "stylesheets": self.stylesheets
+        }
+        return sha256(json.dumps(media, sort_keys=True).encode("utf-8")).hexdigest()
+
+    # Hashes new and changed files, measures new images and, with Pillow,
+    # resizes them across jobs worker processes. stylesheets are paths of
+    # the stylesheets the pages link to. Returns the files that were written
+    # and the ones that were removed.
+    def update(self: Self, jobs: int = 1, stylesheets: Iterable[str] = ()) -> tuple[list[str], list[str]]:
+        stylesheets = list(stylesheets)
+        paths = list_assets(self.media_path) if isdir(self.media_path) else []
+        removed = self.assets.update(paths + stylesheets)
+        self.assets.save()
+
+        written = []
+        if self.fingerprint:
+            written += self.assets.write_copies()
+            self.names = {basename(path): basename(self.assets.fingerprinted(path)) for path in paths}
+            self.stylesheets = {path: self.assets.fingerprinted(path) for path in stylesheets}
+        else:
+            self.names = {}
+            self.stylesheets = {}
+
+        self.images = {}
+        digests = {}
+        for path in paths:
+            name = basename(path)
+            if splitext(name)[1] not in _image_formats:
+                continue
+            digest = self.assets.hash(path)
+            info = self.cache.get(digest)
+            if info is None:
+                size = image_size(path)
+                if size is None:
+                    continue
+                info = ImageInfo(*size)
+            digests[name] = digest
+            self.images[name] = info
+        # Forget images that were replaced or removed
+        self.cache = {digests[name]: info for name, info in self.images.items()}
+
+        if Image is not None:
+            pending = sorted(name for name, info in self.images.items() if not self._is_resized(info))
+            if pending:
+                makedirs(join(self.media_path, _derivatives_dir), exist_ok=True)
+            arguments = ([self.media_path] * len(pending), pending, [digests[name] for name in pending])
+            if jobs > 1 and len(pending) > 1:
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    results = list(executor.map(_make_derivatives, *arguments))
+            else:
+                results = list(map(_make_derivatives, *arguments))
+            for name, (derivatives, derivatives_written) in zip(pending, results):
+                self.images[name].derivatives = derivatives
+                written += derivatives_written
+            # Only with Pillow around, without it every copy looks unused
+            removed += self._prune_derivatives()
+        return written, removed
+
+    def _is_resized(self: Self, info: ImageInfo) -> bool:
+        if info.derivatives is None:
+            return False
+        # Someone may have cleaned out the directory in between
+        return all(isfile(join(self.media_path, file_name)) for file_name in info.derivatives.values())
+
+    # Removes resized copies of images that were replaced or removed, returns
+    # their paths
+    def _prune_derivatives(self: Self) -> list[str]:
+        derivatives_path = join(self.media_path, _derivatives_dir)
+        if not isdir(derivatives_path):
+            return []
+        current = {file_name for info in self.images.values() for file_name in (info.derivatives or {}).values()}
+        removed = []
+        for entry in scandir(derivatives_path):
+            if entry.is_file() and f"{_derivatives_dir}/{entry.name}" not in current:
+                remove(entry.path)
+                removed.append(entry.path)
+        return removed
@@ -0,0 +1,279 @@
+import json
+from hashlib import file_digest, sha256
+from os import chmod, remove, replace, stat
+from os.path import basename, dirname, isfile
+from tempfile import mkstemp
+from typing import IO, Iterable, Self
+
+# Precompressed copies of an output, see compression.py
+sibling_suffixes = (".gz", ".br")
+
+
+class AtomicWriter:
+    # Writes path through a temporary file next to it that only replaces it
+    # on commit(), so readers either see the old file or the new one, never
+    # half of the new one. As a context manager it commits, unless the block
+    # raised or already committed or discarded the file.
+    path: str
+    _temp_path: str
+    _file: IO
+
+    def __init__(self: Self, path: str, mode: str = "wb"):
+        self.path = path
+        # Same directory, so the rename can't end up crossing file systems
+        descriptor, self._temp_path = mkstemp(dir=dirname(path) or ".", prefix="." + basename(path), suffix=".tmp")
+        self._file = open(descriptor, mode, encoding=None if "b" in mode else "utf-8")
+
+    def __enter__(self: Self) -> Self:
+        return self
+
+    def __exit__(self: Self, exception_type, exception, traceback) -> None:
+        if self._file.closed:
+            return
+        if exception_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def write(self: Self, data: bytes | str) -> None:
+        self._file.write(data)
+
+    def commit(self: Self) -> None:
+        try:
+            self._file.close()
+            # mkstemp only lets the owner read the file, the web server has to as well
+            chmod(self._temp_path, 0o644)
+            replace(self._temp_path, self.path)
+        except BaseException:
+            remove(self._temp_path)
+            raise
+
+    def discard(self: Self) -> None:
+        self._file.close()
+        remove(self._temp_path)
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    with AtomicWriter(path) as output_writer:
+        output_writer.write(data)
+
+
+# State files carry the format they were saved in, a state of any other format
+# reads as no state at all. Callers pass a format of their own once the layout
+# of their file changes.
+
+# Contents of a state file written by save_state, None when it's missing,
+# broken or of another format
+def load_state(path: str, state_format: int = 1) -> dict | None:
+    try:
+        with open(path, "r") as state_reader:
+            state = json.load(state_reader)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get("format") != state_format:
+        return None
+    return state
+
+
+# Atomic, so a build that's cut short leaves the last complete state behind
+def save_state(path: str, state: dict, state_format: int = 1) -> None:
+    with AtomicWriter(path, "w") as state_writer:
+        json.dump({"format": state_format} | state, state_writer, indent=1, sort_keys=True)
+
+
+# Whether the file at path still is the one entry describes, entry being the
+# hash and size an OutputManifest recorded for it
+def _is_current(path: str, entry: dict | None, digest: str, size: int) -> bool:
+    if entry is None or entry["hash"] != digest:
+        return False
+    # Cheap check for files that were edited or removed behind our back
+    try:
+        return stat(path).st_size == size == entry["size"]
+    except OSError:
+        return False
+
+
+class StreamedOutput:
+    # Streams text into a temporary file next to path, hashing it on the way.
+    # close() only moves it into place when it differs from the content the
+    # previous entry describes or, without one, from the file that's there.
+    # Unlike OutputManifest.write() the content is never held as a whole, and
+    # it works in worker processes. entry and written go to
+    # OutputManifest.record() afterwards.
+    path: str
+    previous: dict | None
+    # Hash and size of the content, once closed
+    entry: dict | None
+    written: bool
+    _writer: AtomicWriter
+    _size: int
+
+    def __init__(self: Self, path: str, previous: dict | None):
+        self.path = path
+        self.previous = previous
+        self.entry = None
+        self.written = False
+        self._hasher = sha256()
+        self._size = 0
+
+    def __enter__(self: Self) -> Self:
+        self._writer = AtomicWriter(self.path)
+        return self
+
+    def __exit__(self: Self, exception_type, exception, traceback) -> None:
+        # Only reached open when the block raised, nothing was written then
+        if self.entry is None:
+            self._writer.discard()
+
+    def write(self: Self, text: str) -> None:
+        data = text.encode("utf-8")
+        self._hasher.update(data)
+        self._writer.write(data)
+        self._size += len(data)
+
+    def close(self: Self) -> None:
+        digest = self._hasher.hexdigest()
+        self.entry = {"hash": digest, "size": self._size}
+        if self.previous is not None:
+            unchanged = _is_current(self.path, self.previous, digest, self._size)
+        else:
+            # First build with this manifest, but the file may be right already
+            unchanged = _file_digest(self.path, self._size) == digest
+        if unchanged:
+            self._writer.discard()
+        else:
+            self._writer.commit()
+            self.written = True
+
+
+def _file_digest(path: str, size: int) -> str | None:
+    try:
+        if stat(path).st_size != size:
+            return None
+        with open(path, "rb") as output_reader:
+            return file_digest(output_reader, "sha256").hexdigest()
+    except OSError:
+        return None
+
+
+class OutputManifest:
+    # Hash and size of every file the build wrote. Content that hashes the
+    # same as last time isn't written again, which keeps mtimes stable for
+    # rsync and CDN caches.
+    path: str
+    files: dict
+    # Files written since this manifest was opened, in the order they were
+    changed: list[str]
+    # Files written or kept since this manifest was opened
+    seen: set[str]
+    # Files removed since this manifest was opened, precompressed copies too
+    removed: list[str]
+
+    def __init__(self: Self, path: str):
+        self.path = path
+        self.files = {}
+        self.changed = []
+        self.seen = set()
+        self.removed = []
+
+    def load(self: Self) -> None:
+        manifest = load_state(self.path)
+        # Without a manifest every output simply gets written once
+        if manifest is not None:
+            self.files = manifest.get("files", {})
+
+    def save(self: Self) -> None:
+        save_state(self.path, {"files": self.files})
+
+    def is_current(self: Self, path: str, digest: str, size: int) -> bool:
+        return _is_current(path, self.files.get(path), digest, size)
+
+    # Returns whether the file had to be written
+    def write(self: Self, path: str, content: str) -> bool:
+        data = content.encode("utf-8")
+        digest = sha256(data).hexdigest()
+        self.seen.add(path)
+        if self.is_current(path, digest, len(data)):
+            return False
+        if path not in self.files and self._has_content(path, data):
+            # First build with this manifest, but the file is already right
+            self.files[path] = {"hash": digest, "size": len(data)}
+            return False
+
+        write_atomic(path, data)
+        # Precompressed copies of the old content would be served instead of
+        # the new one, they have to go until they're compressed again
+        self._remove_siblings(path)
+        self.files[path] = {"hash": digest, "size": len(data)}
+        self.changed.append(path)
+        return True
+
+    # Records a file written through a StreamedOutput, see write()
+    def record(self: Self, path: str, entry: dict, written: bool) -> None:
+        self.seen.add(path)
+        if not written and path in self.files:
+            # Keeps what's known about its precompressed copies
+            return
+        self.files[path] = entry
+        if written:
+            self._remove_siblings(path)
+            self.changed.append(path)
+
+    # Records a file the build decided not to touch, for builds that start
+    # without a manifest. Cheap when the manifest knows it already.
+    def keep(self: Self, path: str) -> None:
+        if path in self.files:
+            self.seen.add(path)
+            return
+        if not isfile(path):
+            return
+        self.seen.add(path)
+        with open(path, "rb") as output_reader:
+            data = output_reader.read()
+        self.files[path] = {"hash": sha256(data).hexdigest(), "size": len(data)}
+
+    # Removes a file that isn't generated anymore, along with its siblings
+    def remove(self: Self, path: str) -> None:
+        self._remove_siblings(path)
+        self.files.pop(path, None)
+        self.seen.discard(path)
+        if isfile(path):
+            remove(path)
+            self.removed.append(path)
+
+    # Removes the files that were neither written nor kept since this manifest
+    # was opened, e.g. pages of deleted posts, and returns them
+    def prune(self: Self) -> list[str]:
+        pruned = [path for path in self.files if path not in self.seen]
+        for path in pruned:
+            self.remove(path)
+        return pruned
+
+    # Whether the siblings with the given suffixes are up to date with path
+    def is_compressed(self: Self, path: str, suffixes: list[str]) -> bool:
+        entry = self.files[path]
+        if entry.get("compressed") != entry["hash"] or entry.get("suffixes") != suffixes:
+            return False
+        return all(isfile(path + suffix) for suffix in suffixes)
+
+    def record_compressed(self: Self, path: str, suffixes: list[str]) -> None:
+        # E.g. brotli was uninstalled since the last build
+        self._remove_siblings(path, [suffix for suffix in sibling_suffixes if suffix not in suffixes])
+        entry = self.files[path]
+        entry["compressed"] = entry["hash"]
+        entry["suffixes"] = suffixes
+
+    def _has_content(self: Self, path: str, data: bytes) -> bool:
+        try:
+            if stat(path).st_size != len(data):
+                return False
+            with open(path, "rb") as output_reader:
+                return output_reader.read() == data
+        except OSError:
+            return False
+
+    def _remove_siblings(self: Self, path: str, suffixes: Iterable[str] = sibling_suffixes) -> None:
+        for suffix in suffixes:
+            if isfile(path + suffix):
+                remove(path + suffix)
+                self.removed.append(path + suffix)
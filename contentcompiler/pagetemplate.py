@@ -0,0 +1,41 @@
+import re
+from typing import Self, Callable
+
+from mdparsertypes import Sink
+
+_placeholder = re.compile(r"\$([A-Z][A-Z_]*)")
+
+
+class PageTemplate:
+    source: str
+    # Alternating literal text and slot names, starting and ending with a
+    # literal (which may be empty)
+    _segments: list[str]
+
+    def __init__(self: Self, source: str, slots: set[str]):
+        self.source = source
+        self._segments = []
+
+        last_index = 0
+        for match in _placeholder.finditer(source):
+            if match.group(1) not in slots:
+                raise ValueError(f"Unknown placeholder ${match.group(1)} in template")
+            self._segments.append(source[last_index:match.start()])
+            self._segments.append(match.group(1))
+            last_index = match.end()
+        self._segments.append(source[last_index:])
+
+    # Values are either strings or callables that write their content into the
+    # sink themselves, which lets the post body be streamed into the page.
+    # Values are inserted as is, placeholders inside them are left alone.
+    def render(self: Self, write: Sink, values: dict[str, str | Callable[[Sink], None]]) -> None:
+        for n, segment in enumerate(self._segments):
+            if n % 2 == 0:
+                write(segment)
+                continue
+
+            value = values.get(segment, "")
+            if type(value) is str:
+                write(value)
+            else:
+                value(write)
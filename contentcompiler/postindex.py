@@ -0,0 +1,85 @@
+import re
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from os import scandir
+from os.path import splitext
+from typing import Self
+
+import yaml
+
+# Same delimiter python-frontmatter looks for
+_boundary = re.compile(r"-{3,}\s*")
+# The C loader is a lot faster, but only there if PyYAML was built with libyaml
+_yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def post_date(value: date | datetime) -> datetime:
+    # Posts are dated to the hour at most, all in UTC
+    if type(value) is datetime:
+        return datetime(value.year, value.month, value.day, value.hour, tzinfo=timezone.utc)
+    if type(value) is date:
+        return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+    raise ValueError(f"Not a post date: {value!r}")
+
+
+# Reads the frontmatter of a post and nothing after it
+def read_metadata(path: str) -> dict:
+    with open(path, "rb") as post_reader:
+        line = post_reader.readline()
+        while line and not line.strip():
+            line = post_reader.readline()
+        if not _boundary.fullmatch(line.decode("utf-8")):
+            return {}
+
+        header = []
+        for line in iter(post_reader.readline, b""):
+            if _boundary.fullmatch(line.decode("utf-8")):
+                metadata = yaml.load(b"".join(header), Loader=_yaml_loader)
+                return metadata if isinstance(metadata, dict) else {}
+            header.append(line)
+    # Never closed, so it's not frontmatter but part of the body
+    return {}
+
+
+@dataclass(slots=True)
+class PostMeta:
+    source_file: str
+    path: str
+    title: str
+    byline: str
+    preview: str
+    date: datetime
+    tags: list[str]
+
+    @classmethod
+    def read(cls, source_file: str, path: str) -> Self:
+        metadata = read_metadata(path)
+        tags = metadata.get("tags") or []
+        if isinstance(tags, str):
+            tags = [tags]
+        return cls(source_file, path,
+                   metadata.get("title", "Untitled Blog Post"),
+                   metadata.get("description", ""),
+                   metadata.get("preview", ""),
+                   post_date(metadata.get("date")),
+                   tags)
+
+    # What the listings need to know about the post, see listings.py
+    def listing(self: Self) -> dict:
+        return {
+            "title": self.title,
+            "date": self.date,
+            "tags": self.tags,
+            "page": splitext(self.source_file)[0] + ".html"
+        }
+
+
+# Metadata of every post in source_path, newest first. Posts from the same
+# date are ordered by file name.
+def scan_posts(source_path: str) -> list[PostMeta]:
+    entries = sorted((entry for entry in scandir(source_path)
+                      if entry.is_file() and splitext(entry.name)[1] == ".md"),
+                     key=lambda entry: entry.name)
+    posts = [PostMeta.read(entry.name, entry.path) for entry in entries]
+    posts.sort(key=lambda post: post.date, reverse=True)
+    return posts
@@ -0,0 +1,93 @@
+import json
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict
+from time import perf_counter
+from typing import Self
+
+from mdparser import ParserStats
+
+# In the order they happen, for the summary columns
+_phases = ("read", "frontmatter", "block parse", "inline parse", "render", "template", "write",
+           "feed build", "feed serialize")
+
+
+class PostProfile:
+    # Time spent per phase and parser counters of one post, or of the feeds
+    phases: dict[str, float]
+    stats: ParserStats
+
+    def __init__(self: Self):
+        self.phases = {}
+        self.stats = ParserStats()
+
+    @contextmanager
+    def timed(self: Self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def add(self: Self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_parse(self: Self) -> None:
+        # The parser only times itself as a whole and the inline part of it
+        self.add("inline parse", self.stats.inline_seconds)
+        self.add("block parse", self.stats.seconds - self.stats.inline_seconds)
+
+    def merge(self: Self, other: Self) -> None:
+        for name, seconds in other.phases.items():
+            self.add(name, seconds)
+        self.stats = other.stats
+
+    def total(self: Self) -> float:
+        return sum(self.phases.values())
+
+
+# Times the block as the given phase of profile, does nothing without one
+def phase(profile: PostProfile | None, name: str):
+    if profile is None:
+        return nullcontext()
+    return profile.timed(name)
+
+
+class BuildProfile:
+    posts: dict[str, PostProfile]
+    feeds: PostProfile
+
+    def __init__(self: Self):
+        self.posts = {}
+        self.feeds = PostProfile()
+
+    def post(self: Self, source_file: str) -> PostProfile:
+        return self.posts.setdefault(source_file, PostProfile())
+
+    def to_json(self: Self) -> dict:
+        return {
+            "posts": {source_file: {"phases": profile.phases, "parser": asdict(profile.stats)}
+                      for source_file, profile in self.posts.items()},
+            "feeds": {"phases": self.feeds.phases}
+        }
+
+    def save(self: Self, path: str) -> None:
+        with open(path, "w") as profile_writer:
+            json.dump(self.to_json(), profile_writer, indent=1, sort_keys=True)
+
+    # Slowest posts first, so the pathological one is at the top
+    def summary(self: Self, top: int = 20) -> str:
+        posts = sorted(self.posts.items(), key=lambda item: item[1].total(), reverse=True)
+        lines = [f"{'post':<32}{'total':>10}" + "".join(f"{name:>16}" for name in _phases[:7])
+                 + f"{'chars':>10}{'tokens':>8}{'fallbacks':>11}{'peeks':>8}{'depth':>7}"]
+        for source_file, profile in posts[:top]:
+            stats = profile.stats
+            lines.append(f"{source_file[:31]:<32}{profile.total() * 1000:>8.2f}ms"
+                         + "".join(f"{profile.phases.get(name, 0.0) * 1000:>14.2f}ms" for name in _phases[:7])
+                         + f"{stats.characters:>10}{stats.inline_tokens:>8}{stats.fallbacks:>11}"
+                         + f"{stats.peeks:>8}{max(stats.max_list_depth, stats.max_inline_depth):>7}")
+        if len(posts) > top:
+            lines.append(f"... and {len(posts) - top} more")
+
+        feeds = "  ".join(f"{name} {self.feeds.phases.get(name, 0.0) * 1000:.2f}ms" for name in _phases[7:])
+        lines.append(f"feeds: {feeds}")
+        return "\n".join(lines)